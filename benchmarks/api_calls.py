@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+"""
+Count the docker API calls and measure the wall time of every state of the
+dockerimp module against the fake daemon in fake_daemon.py.
+
+Every scenario starts a fresh fake daemon seeded with --containers
+background containers and --images images, runs the setup steps of the
+scenario and then measures one run of the module. The calls made by the
+measured run are compared to api_calls_baseline.json and the script exits
+with a non-zero status if any scenario makes more calls of any kind than
+the baseline allows, or if the measured run does not report the expected
+changed value and actions.
+
+    python benchmarks/api_calls.py
+    python benchmarks/api_calls.py --scenario running_unchanged --latency 0.005
+    python benchmarks/api_calls.py --update-baseline
+
+The measured run of a script scenario runs dockerimp.py in a new process
+with the options in ANSIBLE_MODULE_ARGS, the way ansible runs it, so that
+the options go through the argument spec of AnsibleModule.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, HERE)
+
+import dockerimp
+from fake_daemon import FakeDaemon
+
+BASELINE = os.path.join(HERE, "api_calls_baseline.json")
+MODULE = os.path.join(HERE, "..", "dockerimp.py")
+
+IMAGE = "bench/image-0:latest"
+OTHER_IMAGE = "bench/image-1:latest"
+# Registry that refuses connections, so the digest check falls back to a pull
+REMOTE_IMAGE = "127.0.0.1:1/bench/remote:latest"
+# Image on the registry of the fake daemon. {registry} is replaced with its
+# host when the scenario is run.
+REGISTRY_IMAGE = "{registry}/bench/registry:latest"
+# Archive of the image_saved and image_loaded scenarios, removed before and
+# after every scenario
+ARCHIVE = os.path.join(tempfile.gettempdir(), "dockerimp-bench-{0}.tar".format(os.getpid()))
+
+# Resource limits that are passed in the host config when creating
+RESOURCES = {'mem_limit': "64m", 'memswap_limit': "128m", 'cpu_shares': 512, 'cpuset': "0", 'blkio_weight': 300}
+
+def container(state, **kwargs):
+    params = {'state': state, 'name': "web", 'image': IMAGE}
+    params.update(kwargs)
+    return params
+
+def scenario(setup, step, changed, actions = None, faults = None, script = False):
+    """
+    A scenario runs the setup steps and then measures the step. changed is
+    the expected changed of the measured step and actions the expected
+    number of each action in its msg. faults maps calls to the number of
+    server errors the fake daemon returns for them in the measured step.
+    With script the step is run as the module script.
+    """
+    return {
+        'setup': setup, 'step': step, 'changed': changed, 'actions': actions or {},
+        'faults': faults or {}, 'script': script,
+    }
+
+CREATED = {'CREATED': 1, 'STARTED': 1}
+REMOVED = {'STOPPED': 1, 'REMOVED': 1}
+RECREATED = {'STOPPED': 1, 'REMOVED': 1, 'CREATED': 1, 'STARTED': 1}
+
+SCENARIOS = {
+    'present_new':              scenario([], container("present"), True, {'CREATED': 1}),
+    'present_unchanged':        scenario([container("present")], container("present"), False),
+    'running_new':              scenario([], container("running"), True, CREATED),
+    'running_unchanged':        scenario([container("running")], container("running"), False),
+    # A name longer than an ID prefix that is not one
+    'running_unchanged_long':   scenario([container("running", name = "frontend-web")],
+                                    container("running", name = "frontend-web"), False),
+    'running_unchanged_retry':  scenario([container("running")], container("running"), False, faults = {'containers': 2}),
+    'running_new_resources':    scenario([], container("running", **RESOURCES), True, CREATED),
+    'running_changed_env':      scenario([container("running", env = {'A': "1"})], container("running", env = {'A': "2"}),
+                                    True, RECREATED),
+    'running_changed_image':    scenario([container("running")], container("running", image = OTHER_IMAGE), True, RECREATED),
+    # docker-py 1.x cannot update the restart policy in place
+    'running_changed_restart':  scenario([container("running")], container("running", restart_policy = "always"),
+                                    True, RECREATED),
+    'running_latest_unchanged': scenario([container("running")], container("running_latest"), False),
+    'stopped':                  scenario([container("running")], container("stopped"), True, {'STOPPED': 1}),
+    'restarted':                scenario([container("running")], container("restarted"), True, {'RESTARTED': 1}),
+    'stats_label':              scenario([container("running")],
+                                    {'state': "stats", 'label': "dockerimp.fingerprint", 'window': 1}, False),
+    'stats_names':              scenario([{'containers': [{'name': "web-0", 'image': IMAGE}, {'name': "web-1", 'image': IMAGE}]}],
+                                    {'state': "stats", 'name': ["web-0", "web-1"], 'window': 1}, False, script = True),
+    'logs_bounded':             scenario([container("running")], {'state': "logs", 'name': "web", 'max_bytes': "64k"}, False),
+    'absent':                   scenario([container("running")], container("absent"), True, REMOVED),
+    'absent_missing':           scenario([], container("absent"), False),
+    'absent_force':             scenario([container("running")], container("absent", force_remove = True), True, {'REMOVED': 1}),
+    'absent_stop_signal':       scenario([container("running")], container("absent", stop_signal = "SIGINT"), True, REMOVED),
+    'absent_stop_signal_now':   scenario([container("running")], container("absent", stop_signal = "SIGINT", stop_timeout = 0),
+                                    True, REMOVED),
+    'image_present_existing':   scenario([], {'state': "image_present", 'image': IMAGE}, False),
+    'image_present_missing':    scenario([], {'state': "image_present", 'image': "bench/new:1"}, True, {'PULLED': 1}),
+    # The pull finds that the image is up to date
+    'image_latest':             scenario([{'state': "image_present", 'image': REMOTE_IMAGE}],
+                                    {'state': "image_latest", 'image': REMOTE_IMAGE}, False),
+    'image_latest_unchanged':   scenario([{'state': "image_present", 'image': REGISTRY_IMAGE}],
+                                    {'state': "image_latest", 'image': REGISTRY_IMAGE, 'insecure_registry': True}, False),
+    'image_present_list':       scenario([], {'state': "image_present", 'image': ["bench/new:1", "bench/new:2"]},
+                                    True, {'PULLED': 2}, script = True),
+    'image_absent':             scenario([{'state': "image_present", 'image': "bench/new:1"}],
+                                    {'state': "image_absent", 'image': "bench/new:1"}, True, {'REMOVED': 1}),
+    'image_pruned':             scenario([{'state': "image_present", 'image': ["bench/new:1", "bench/new:2"]}],
+                                    {'state': "image_pruned", 'image': "bench/new*", 'keep': 0}, True, {'REMOVED': 2}),
+    'image_pruned_list':        scenario([{'state': "image_present", 'image': ["bench/new:1", "other/new:1"]}],
+                                    {'state': "image_pruned", 'image': ["bench/new*", "other/*"], 'keep': 0},
+                                    True, {'REMOVED': 2}, script = True),
+    'image_saved':              scenario([], {'state': "image_saved", 'image': IMAGE, 'path': ARCHIVE}, True, {'SAVED': 1}),
+    'image_saved_unchanged':    scenario([{'state': "image_saved", 'image': IMAGE, 'path': ARCHIVE}],
+                                    {'state': "image_saved", 'image': IMAGE, 'path': ARCHIVE}, False),
+    'image_loaded_existing':    scenario([{'state': "image_saved", 'image': IMAGE, 'path': ARCHIVE}],
+                                    {'state': "image_loaded", 'path': ARCHIVE}, False),
+    'batch_running':            scenario([], {'containers': [
+                                    {'name': "web-{0}".format(i), 'image': IMAGE} for i in range(10)
+                                ]}, True, {'CREATED': 10, 'STARTED': 10}),
+    # The cpuset of an item is a YAML int
+    'batch_cpuset_unchanged':   scenario([{'containers': [{'name': "web", 'image': IMAGE, 'cpuset': 0}]}],
+                                    {'containers': [{'name': "web", 'image': IMAGE, 'cpuset': 0}]}, False),
+    # Four tiers of ten containers, each linked to a container of the tier below
+    'batch_linked':             scenario([], {'containers': [
+                                    dict({'name': "tier{0}-{1}".format(t, i), 'image': IMAGE},
+                                        **({'links': "tier{0}-{1}".format(t - 1, i)} if t else {}))
+                                    for t in range(4) for i in range(10)
+                                ]}, True, {'CREATED': 40, 'STARTED': 40}),
+}
+
+def run_module(daemon, params, script = False):
+    params = json.loads(json.dumps(params).replace("{registry}", daemon.registry))
+    params['client_url'] = daemon.url
+    if script:
+        result = run_script(params)
+    else:
+        args = dict((k, v.get('default')) for k, v in dockerimp.ARGUMENT_SPEC.items())
+        args.update(params)
+        result = dockerimp.run_manager(dockerimp.HelperModule(args))
+    if result.get('failed'):
+        raise RuntimeError("Module failed: {0}".format(result['msg']))
+    return result
+
+def run_script(params):
+    with tempfile.NamedTemporaryFile("w", suffix = ".json", delete = False) as f:
+        json.dump({'ANSIBLE_MODULE_ARGS': params}, f)
+    try:
+        process = subprocess.Popen([sys.executable, MODULE, f.name], stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        stdout, stderr = process.communicate()
+    finally:
+        os.unlink(f.name)
+    try:
+        return json.loads(stdout.decode("utf-8", "replace"))
+    except ValueError:
+        output = (stdout + stderr).decode("utf-8", "replace").strip()
+        raise RuntimeError("Module failed: {0}".format(output.splitlines()[-1] if output else "no output"))
+
+def remove_archive():
+    for path in (ARCHIVE, ARCHIVE + ".sha256"):
+        if os.path.exists(path):
+            os.unlink(path)
+
+def get_actions(result):
+    # Number of each action in the msg of a run. The changes of a batch are
+    # keyed by the container name.
+    actions = {}
+    if not result['changed']:
+        return actions
+    for change in result['msg']:
+        action, info = list(change.items())[0]
+        if not action.isupper():
+            action = list(info)[0]
+        actions[action] = actions.get(action, 0) + 1
+    return actions
+
+def check_result(name, result):
+    # A scenario that does less than it should would pass with fewer calls,
+    # so what the run did is checked as well
+    expected = SCENARIOS[name]
+    errors = []
+    if result['changed'] != expected['changed']:
+        errors.append("{0}: changed is {1}, expected {2}".format(name, result['changed'], expected['changed']))
+    actions = get_actions(result)
+    if actions != expected['actions']:
+        errors.append("{0}: actions are {1}, expected {2}".format(
+            name, json.dumps(actions, sort_keys = True), json.dumps(expected['actions'], sort_keys = True)))
+    return errors
+
+def run_scenario(name, containers, images, latency):
+    setup, params, faults = SCENARIOS[name]['setup'], SCENARIOS[name]['step'], SCENARIOS[name]['faults']
+    script = SCENARIOS[name]['script']
+    remove_archive()
+    path = os.path.join(tempfile.mkdtemp(), "docker.sock")
+    daemon = FakeDaemon(path, containers, images).start()
+    try:
+        for step in setup:
+            run_module(daemon, step)
+        daemon.docker.latency = latency
+        daemon.reset_calls()
+        for call, count in faults.items():
+            daemon.docker.fail(call, count)
+        start = time.time()
+        result = run_module(daemon, params, script)
+        wall = time.time() - start
+        calls = daemon.calls
+    finally:
+        daemon.stop()
+        os.rmdir(os.path.dirname(path))
+        remove_archive()
+    return {
+        'wall': round(wall, 4), 'calls': calls, 'total': sum(calls.values()),
+        'unexpected': check_result(name, result),
+    }
+
+def compare(results, baseline):
+    regressions = []
+    for name, result in sorted(results.items()):
+        old = baseline.get(name)
+        if old is None:
+            continue
+        for call, count in sorted(result['calls'].items()):
+            if count > old['calls'].get(call, 0):
+                regressions.append("{0}: {1} {2} calls, baseline {3}".format(
+                    name, count, call, old['calls'].get(call, 0)))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description = "Count dockerimp API calls per scenario")
+    parser.add_argument("--scenario", action = "append", choices = sorted(SCENARIOS),
+            help = "Scenario to run, may be given many times. Defaults to all scenarios.")
+    parser.add_argument("--containers", type = int, default = 1500,
+            help = "Number of background containers on the fake daemon")
+    parser.add_argument("--images", type = int, default = 100,
+            help = "Number of images on the fake daemon")
+    parser.add_argument("--latency", type = float, default = 0.0,
+            help = "Seconds to delay every request of the measured run")
+    parser.add_argument("--output", help = "Write the results to this JSON file")
+    parser.add_argument("--update-baseline", action = "store_true",
+            help = "Write the call counts to the baseline file")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.scenario or sorted(SCENARIOS):
+        results[name] = run_scenario(name, args.containers, args.images, args.latency)
+        calls = " ".join("{0}={1}".format(x.replace(" ", "_"), y) for x, y in sorted(results[name]['calls'].items()))
+        print("{0:26} {1:8.4f}s {2:3} calls  {3}".format(name, results[name]['wall'], results[name]['total'], calls))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent = 2, sort_keys = True)
+
+    unexpected = [x for name in sorted(results) for x in results[name]['unexpected']]
+    if unexpected:
+        # The call counts of a run that did the wrong thing are not
+        # comparable, so they are not written to the baseline either
+        print("Scenarios did not do what was expected:")
+        for i in unexpected:
+            print("  " + i)
+        sys.exit(1)
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+
+    if args.update_baseline:
+        for name, result in results.items():
+            baseline[name] = {'calls': result['calls'], 'total': result['total']}
+        with open(BASELINE, "w") as f:
+            json.dump(baseline, f, indent = 2, sort_keys = True)
+            f.write("\n")
+        return
+
+    regressions = compare(results, baseline)
+    if regressions:
+        print("API call counts increased:")
+        for i in regressions:
+            print("  " + i)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
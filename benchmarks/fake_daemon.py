@@ -0,0 +1,905 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the Docker Engine API served on a unix socket.
+
+The daemon keeps its containers and images in memory and records every
+API call it receives, so that benchmarks can count how many calls of each
+kind a module run makes. It can be seeded with any number of containers and
+images and every request can be delayed to simulate a busy daemon.
+
+    python benchmarks/fake_daemon.py --socket /tmp/docker.sock --containers 1500
+
+or from python:
+
+    daemon = FakeDaemon("/tmp/docker.sock", containers = 1500, images = 100)
+    daemon.start()
+    ...
+    print(daemon.calls)
+    daemon.stop()
+"""
+
+import argparse
+import collections
+import hashlib
+import io
+import json
+import os
+import re
+import struct
+import sys
+import tarfile
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    from urllib.parse import parse_qs, unquote, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    from urllib import unquote
+    from urlparse import parse_qs, urlparse
+
+def make_id(*parts):
+    return hashlib.sha256(":".join(str(x) for x in parts).encode("utf-8")).hexdigest()
+
+def split_tag(name):
+    # The tag is after the last colon unless the colon belongs to a registry port
+    repo, _, tag = name.rpartition(":")
+    if not repo or "/" in tag:
+        return name, "latest"
+    return repo, tag
+
+class NotFound(Exception):
+    pass
+
+class Conflict(Exception):
+    pass
+
+class FakeDocker(object):
+    """
+    In-memory state of the fake daemon.
+    """
+
+    def __init__(self, containers = 0, images = 0, latency = 0.0, health_delay = 0.2, log_lines = 10000,
+            stats_interval = 1.0):
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.latency = latency
+        self.health_delay = health_delay
+        self.log_lines = log_lines
+        self.stats_interval = stats_interval
+        self.calls = collections.Counter()
+        self.faults = collections.Counter()
+        self.containers = collections.OrderedDict()
+        self.images = collections.OrderedDict()
+        self.events = []
+        self.counter = 0
+
+        for i in range(images):
+            self.add_image("bench/image-{0}:latest".format(i))
+        for i in range(containers):
+            image = "bench/image-{0}:latest".format(i % images) if images else "busybox:latest"
+            if image not in self.tags():
+                self.add_image(image)
+            container = self.create_container("bench-{0}".format(i), {'Image': image, 'Cmd': ["sleep", "1d"]})
+            self.start_container(container['Id'], {})
+
+    def record(self, call):
+        with self.lock:
+            self.calls[call] += 1
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls = collections.Counter()
+
+    def fail(self, call, count = 1):
+        # The next count requests of the call get a server error
+        with self.lock:
+            self.faults[call] += count
+
+    def take_fault(self, call):
+        with self.lock:
+            if self.faults[call] > 0:
+                self.faults[call] -= 1
+                return True
+            return False
+
+    def emit(self, event_type, action, object_id, attributes = None):
+        with self.lock:
+            now = time.time()
+            event = {
+                'Type': event_type, 'Action': action, 'status': action, 'id': object_id,
+                'Actor': {'ID': object_id, 'Attributes': attributes or {}},
+                'time': int(now), 'timeNano': int(now * 1e9),
+            }
+            if event_type == "container":
+                event['from'] = attributes.get('image') if attributes else None
+            self.events.append(event)
+            self.changed.notify_all()
+
+    # Images
+
+    def tags(self):
+        return dict((tag, image['Id']) for image in self.images.values() for tag in image['RepoTags'])
+
+    def add_image(self, name, layers = 3):
+        with self.lock:
+            repo, tag = split_tag(name)
+            name = "{0}:{1}".format(repo, tag)
+            self.counter += 1
+            image_id = "sha256:" + make_id("image", name, self.counter)
+            old = self.tags().get(name)
+            if old:
+                self.untag(old, name)
+            self.images[image_id] = {
+                'Id': image_id,
+                'RepoTags': [name],
+                'RepoDigests': ["{0}@sha256:{1}".format(repo, make_id("digest", image_id))],
+                'Created': int(time.time()),
+                'Size': 1024 * 1024 * layers,
+                'VirtualSize': 1024 * 1024 * layers,
+                'Layers': [make_id("layer", name, i)[:12] for i in range(layers)],
+            }
+            return self.images[image_id]
+
+    def untag(self, image_id, name):
+        image = self.images[image_id]
+        image['RepoTags'] = [x for x in image['RepoTags'] if x != name]
+        if not image['RepoTags']:
+            # The digest of the repository is kept like the real daemon does
+            image['RepoTags'] = ["<none>:<none>"]
+
+    def find_image(self, ref):
+        with self.lock:
+            tags = self.tags()
+            repo, tag = split_tag(ref)
+            name = "{0}:{1}".format(repo, tag)
+            if name in tags:
+                return self.images[tags[name]]
+            for image_id in self.images:
+                if image_id == ref or image_id.split(":")[-1].startswith(ref.split(":")[-1]) and len(ref) >= 12:
+                    return self.images[image_id]
+            raise NotFound("No such image: {0}".format(ref))
+
+    def list_images(self, name = None):
+        with self.lock:
+            result = []
+            for image in self.images.values():
+                if name and not any(split_tag(x)[0] == name or x == name for x in image['RepoTags']):
+                    continue
+                result.append(dict((k, v) for k, v in image.items() if k != 'Layers'))
+            return result
+
+    def inspect_image(self, ref):
+        image = self.find_image(ref)
+        return {
+            'Id': image['Id'], 'RepoTags': image['RepoTags'], 'RepoDigests': image['RepoDigests'],
+            'Created': image['Created'], 'Size': image['Size'],
+            'Config': {'Cmd': ["sh"], 'Env': [], 'Labels': {}},
+            'RootFS': {'Type': "layers", 'Layers': ["sha256:" + x for x in image['Layers']]},
+        }
+
+    def pull(self, repo, tag):
+        # Yields the progress messages of a pull. An image that already
+        # exists is reported to be up to date and is left as is.
+        name = "{0}:{1}".format(repo, tag or "latest")
+        yield {'status': "Pulling from {0}".format(repo), 'id': tag or "latest"}
+        with self.lock:
+            exists = name in self.tags()
+            image = self.find_image(name) if exists else self.add_image(name)
+        for layer in image['Layers']:
+            if exists:
+                yield {'status': "Already exists", 'progressDetail': {}, 'id': layer}
+                continue
+            yield {'status': "Pulling fs layer", 'progressDetail': {}, 'id': layer}
+            yield {'status': "Downloading", 'progressDetail': {'current': 1048576, 'total': 1048576}, 'id': layer}
+            yield {'status': "Download complete", 'progressDetail': {}, 'id': layer}
+            yield {'status': "Pull complete", 'progressDetail': {}, 'id': layer}
+        yield {'status': "Digest: {0}".format(image['RepoDigests'][0].split("@")[1])}
+        if exists:
+            yield {'status': "Status: Image is up to date for {0}".format(name)}
+        else:
+            yield {'status': "Status: Downloaded newer image for {0}".format(name)}
+            self.emit("image", "pull", name)
+
+    def registry_manifest(self, repo, reference):
+        # Returns the digest and the manifest that the registry has for an
+        # image. The registry has the images that the daemon pulled from it.
+        with self.lock:
+            try:
+                image = self.find_image("{0}:{1}".format(repo, reference))
+            except NotFound:
+                return None, None
+            digests = [x.split("@")[1] for x in image['RepoDigests'] if x.split("@")[0] == repo]
+            if not digests:
+                return None, None
+            manifest = {
+                'schemaVersion': 2,
+                'mediaType': "application/vnd.docker.distribution.manifest.v2+json",
+                'config': {'size': 1024, 'digest': image['Id']},
+                'layers': [{'size': 1024 * 1024, 'digest': "sha256:" + make_id("blob", x)} for x in image['Layers']],
+            }
+            return digests[0], manifest
+
+    def remove_image(self, ref, force = False):
+        with self.lock:
+            image = self.find_image(ref)
+            used = [x for x in self.containers.values() if x['Image'] == image['Id']]
+            if used and not force:
+                raise Conflict("image is being used by container {0}".format(used[0]['Id'][:12]))
+            result = []
+            repo, tag = split_tag(ref)
+            name = "{0}:{1}".format(repo, tag)
+            if name in image['RepoTags'] and len(image['RepoTags']) > 1:
+                self.untag(image['Id'], name)
+                result.append({'Untagged': name})
+            else:
+                del self.images[image['Id']]
+                result.extend({'Untagged': x} for x in image['RepoTags'])
+                result.append({'Deleted': image['Id']})
+            self.emit("image", "delete", image['Id'])
+            return result
+
+    def tag_image(self, ref, repo, tag):
+        with self.lock:
+            image = self.find_image(ref)
+            name = "{0}:{1}".format(repo, tag or "latest")
+            old = self.tags().get(name)
+            if old and old != image['Id']:
+                self.untag(old, name)
+            image['RepoTags'] = [x for x in image['RepoTags'] if x not in ("<none>:<none>", name)] + [name]
+            self.emit("image", "tag", image['Id'], {'name': name})
+
+    def save_image(self, ref):
+        # A docker save archive with the config and a small file per layer
+        image = self.find_image(ref)
+        config = image['Id'].split(":")[-1] + ".json"
+        files = [
+            ("manifest.json", json.dumps([{
+                'Config': config, 'RepoTags': image['RepoTags'],
+                'Layers': ["{0}/layer.tar".format(x) for x in image['Layers']],
+            }]).encode("utf-8")),
+            (config, json.dumps({'config': {'Cmd': ["sh"]}}).encode("utf-8")),
+        ]
+        files.extend(("{0}/layer.tar".format(x), x.encode("ascii") * 1024) for x in image['Layers'])
+        data = io.BytesIO()
+        with tarfile.open(fileobj = data, mode = "w") as archive:
+            for name, content in files:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+        self.emit("image", "save", image['Id'])
+        return data.getvalue()
+
+    def load_image(self, data):
+        with tarfile.open(fileobj = io.BytesIO(data)) as archive:
+            manifest = json.loads(archive.extractfile("manifest.json").read().decode("utf-8"))
+            layers = dict((x['Config'], len(x['Layers'])) for x in manifest)
+        with self.lock:
+            for entry in manifest:
+                image_id = "sha256:" + os.path.basename(entry['Config']).split(".")[0]
+                if image_id not in self.images:
+                    self.images[image_id] = {
+                        'Id': image_id, 'RepoTags': ["<none>:<none>"], 'RepoDigests': [],
+                        'Created': int(time.time()),
+                        'Size': 1024 * 1024 * layers[entry['Config']],
+                        'VirtualSize': 1024 * 1024 * layers[entry['Config']],
+                        'Layers': [make_id("layer", image_id, i)[:12] for i in range(layers[entry['Config']])],
+                    }
+                for name in entry.get('RepoTags') or []:
+                    repo, tag = split_tag(name)
+                    self.tag_image(image_id, repo, tag)
+                self.emit("image", "load", image_id)
+
+    # Containers
+
+    def find_container(self, ref):
+        with self.lock:
+            ref = ref.lstrip("/")
+            for container in self.containers.values():
+                if container['Name'] == "/" + ref or container['Id'] == ref:
+                    return container
+            found = [x for x in self.containers.values() if x['Id'].startswith(ref)]
+            if len(found) == 1:
+                return found[0]
+            raise NotFound("No such container: {0}".format(ref))
+
+    def create_container(self, name, config):
+        with self.lock:
+            image = self.find_image(config['Image'])
+            self.counter += 1
+            name = name or "bench_{0}".format(self.counter)
+            if any(x['Name'] == "/" + name for x in self.containers.values()):
+                raise Conflict("The name /{0} is already in use".format(name))
+            container_id = make_id("container", name, self.counter)
+            host_config = {
+                'Binds': None, 'PortBindings': {}, 'Links': None, 'VolumesFrom': None,
+                'Memory': 0, 'MemorySwap': 0, 'CpuShares': 0, 'CpusetCpus': "",
+                'BlkioWeight': 0, 'RestartPolicy': {'Name': "", 'MaximumRetryCount': 0},
+            }
+            host_config.update(config.get('HostConfig') or {})
+            self.containers[container_id] = {
+                'Id': container_id,
+                'Name': "/" + name,
+                'Created': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                'Image': image['Id'],
+                'Config': {
+                    'Image': config['Image'],
+                    'Cmd': config.get('Cmd') or ["sh"],
+                    'Env': config.get('Env') or [],
+                    'Labels': config.get('Labels') or {},
+                    'ExposedPorts': config.get('ExposedPorts') or {},
+                    'Tty': bool(config.get('Tty')),
+                    'Healthcheck': config.get('Healthcheck'),
+                },
+                'HostConfig': host_config,
+                'State': {
+                    'Status': "created", 'Running': False, 'Paused': False,
+                    'Restarting': False, 'Pid': 0, 'ExitCode': 0,
+                },
+            }
+            self.emit("container", "create", container_id, {'name': name, 'image': config['Image']})
+            return self.containers[container_id]
+
+    def list_containers(self, all = False, filters = None):
+        with self.lock:
+            result = []
+            for c in self.containers.values():
+                if not all and not c['State']['Running']:
+                    continue
+                if filters and not self.match_filters(c, filters):
+                    continue
+                result.append(self.summary(c))
+            return result
+
+    def match_filters(self, container, filters):
+        for key, values in filters.items():
+            if key == "name":
+                if not any(re.search(x, container['Name']) for x in values):
+                    return False
+            elif key == "id":
+                if not any(container['Id'].startswith(x) for x in values):
+                    return False
+            elif key == "label":
+                labels = container['Config']['Labels']
+                for value in values:
+                    k, _, v = value.partition("=")
+                    if k not in labels or (v and labels[k] != v):
+                        return False
+            elif key == "status":
+                if container['State']['Status'] not in values:
+                    return False
+        return True
+
+    def summary(self, c):
+        running = c['State']['Running']
+        return {
+            'Id': c['Id'],
+            'Names': [c['Name']],
+            'Image': c['Config']['Image'],
+            'ImageID': c['Image'],
+            'Command': " ".join(c['Config']['Cmd']),
+            'Created': 0,
+            'State': c['State']['Status'],
+            'Status': "Up 1 second" if running else "Exited (0) 1 second ago",
+            'Labels': c['Config']['Labels'],
+            'Ports': [],
+        }
+
+    def start_container(self, ref, host_config):
+        with self.lock:
+            c = self.find_container(ref)
+            if host_config:
+                c['HostConfig'].update(host_config)
+            for link in c['HostConfig'].get('Links') or []:
+                if not self.find_container(link.split(":")[0])['State']['Running']:
+                    raise Conflict("Cannot link to a non running container: {0}".format(link))
+            for source in c['HostConfig'].get('VolumesFrom') or []:
+                self.find_container(source.split(":")[0])
+            if not c['State']['Running']:
+                c['State'].update({'Status': "running", 'Running': True, 'Pid': 1000 + self.counter})
+                self.emit("container", "start", c['Id'], {'name': c['Name'][1:], 'image': c['Config']['Image']})
+                if c['Config'].get('Healthcheck'):
+                    # Containers with a health check become healthy after a delay
+                    c['State']['Health'] = {'Status': "starting", 'FailingStreak': 0, 'Log': []}
+                    timer = threading.Timer(self.health_delay, self.set_healthy, (c['Id'], c['State']['Pid']))
+                    timer.daemon = True
+                    timer.start()
+
+    def set_healthy(self, container_id, pid):
+        with self.lock:
+            c = self.containers.get(container_id)
+            if c and c['State']['Running'] and c['State']['Pid'] == pid:
+                c['State']['Health']['Status'] = "healthy"
+                self.emit("container", "health_status: healthy", container_id, {'name': c['Name'][1:]})
+
+    def stop_container(self, ref, signal = None):
+        with self.lock:
+            c = self.find_container(ref)
+            if c['State']['Running']:
+                attributes = {'name': c['Name'][1:], 'image': c['Config']['Image']}
+                if signal:
+                    attributes['signal'] = signal
+                    self.emit("container", "kill", c['Id'], attributes)
+                c['State'].update({'Status': "exited", 'Running': False, 'Pid': 0})
+                self.emit("container", "die", c['Id'], attributes)
+                if not signal:
+                    self.emit("container", "stop", c['Id'], attributes)
+
+    def restart_container(self, ref):
+        with self.lock:
+            c = self.find_container(ref)
+            self.stop_container(c['Id'])
+            self.start_container(c['Id'], {})
+            self.emit("container", "restart", c['Id'], {'name': c['Name'][1:]})
+
+    def rename_container(self, ref, name):
+        with self.lock:
+            c = self.find_container(ref)
+            if any(x['Name'] == "/" + name for x in self.containers.values()):
+                raise Conflict("The name /{0} is already in use".format(name))
+            old = c['Name']
+            c['Name'] = "/" + name
+            self.emit("container", "rename", c['Id'], {'name': name, 'oldName': old})
+
+    def update_container(self, ref, body):
+        with self.lock:
+            c = self.find_container(ref)
+            for key, value in body.items():
+                c['HostConfig'][key] = value
+            self.emit("container", "update", c['Id'], {'name': c['Name'][1:]})
+
+    def remove_container(self, ref, force = False):
+        with self.lock:
+            c = self.find_container(ref)
+            if c['State']['Running']:
+                if not force:
+                    raise Conflict("You cannot remove a running container {0}".format(c['Id']))
+                self.stop_container(c['Id'], "SIGKILL")
+            del self.containers[c['Id']]
+            self.emit("container", "destroy", c['Id'], {'name': c['Name'][1:]})
+
+    def wait_container(self, ref, timeout = None):
+        with self.lock:
+            c = self.find_container(ref)
+            deadline = time.time() + (timeout or 3600)
+            while c['State']['Running'] and time.time() < deadline:
+                self.changed.wait(0.1)
+            return {'StatusCode': c['State']['ExitCode']}
+
+    def iter_logs(self, ref, stdout = True, stderr = True, tail = None, since = None, until = None):
+        # Every container has log_lines lines, one a second up to now, and
+        # every tenth line is written to stderr
+        c = self.find_container(ref)
+        now = int(time.time())
+        first = now - self.log_lines
+        start = 0 if tail is None else max(0, self.log_lines - tail)
+        for i in range(start, self.log_lines):
+            timestamp = first + i
+            if (since and timestamp < since) or (until and timestamp > until):
+                continue
+            name = "stderr" if i % 10 == 9 else "stdout"
+            if (name == "stdout" and stdout) or (name == "stderr" and stderr):
+                yield name, "{0} line {1} of {2}\n".format(timestamp, i, c['Name'][1:]).encode("utf-8")
+
+    def iter_stats(self, ref):
+        # Yields a sample every stats_interval seconds while the container
+        # runs. The container uses half a CPU of four and its memory use
+        # goes up and down.
+        c = self.find_container(ref)
+        i = 0
+        while c['State']['Running']:
+            elapsed = int(i * self.stats_interval * 1e9)
+            yield {
+                'read': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                'cpu_stats': {
+                    'cpu_usage': {'total_usage': elapsed // 2, 'percpu_usage': [0] * 4},
+                    'system_cpu_usage': elapsed * 4, 'online_cpus': 4,
+                },
+                'memory_stats': {
+                    'usage': (100 + i % 5 * 10) * 1024 * 1024, 'limit': 1024 ** 3,
+                    'stats': {'cache': 10 * 1024 * 1024},
+                },
+                'networks': {'eth0': {'rx_bytes': i * 1000, 'tx_bytes': i * 500}},
+                'blkio_stats': {'io_service_bytes_recursive': [
+                    {'major': 8, 'minor': 0, 'op': "Read", 'value': i * 4096},
+                    {'major': 8, 'minor': 0, 'op': "Write", 'value': i * 8192},
+                ]},
+            }
+            i += 1
+            time.sleep(self.stats_interval)
+
+    def iter_events(self, since = None, until = None, filters = None):
+        # Yields past events from since and then new events until the until
+        # time passes. Without until the stream is open until the client
+        # goes away.
+        position = 0
+        while True:
+            with self.lock:
+                while position >= len(self.events):
+                    if until is not None and time.time() >= until:
+                        return
+                    self.changed.wait(0.1 if until is None else max(0.01, min(0.1, until - time.time())))
+                event = self.events[position]
+                position += 1
+            if since is not None and event['time'] < since:
+                continue
+            if until is not None and event['time'] > until:
+                return
+            if filters and not self.match_event(event, filters):
+                continue
+            yield event
+
+    def match_event(self, event, filters):
+        for key, values in filters.items():
+            if key == "container" and event['Type'] == "container":
+                c = self.containers.get(event['id'])
+                names = [event['Actor']['Attributes'].get('name')] + ([c['Name'][1:]] if c else [])
+                if not any(event['id'].startswith(x) or x in names for x in values):
+                    return False
+            elif key == "event" and event['Action'].split(":")[0] not in values:
+                return False
+            elif key == "type" and event['Type'] not in values:
+                return False
+        return True
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    ROUTES = (
+        ("GET",    r"/_ping",                        "ping"),
+        ("GET",    r"/version",                      "version"),
+        ("GET",    r"/info",                         "info"),
+        ("GET",    r"/events",                       "events"),
+        ("GET",    r"/containers/json",              "containers"),
+        ("POST",   r"/containers/create",            "create"),
+        ("GET",    r"/containers/(?P<ref>[^/]+)/json",    "inspect_container"),
+        ("POST",   r"/containers/(?P<ref>[^/]+)/start",   "start"),
+        ("POST",   r"/containers/(?P<ref>[^/]+)/stop",    "stop"),
+        ("POST",   r"/containers/(?P<ref>[^/]+)/restart", "restart"),
+        ("POST",   r"/containers/(?P<ref>[^/]+)/kill",    "kill"),
+        ("POST",   r"/containers/(?P<ref>[^/]+)/rename",  "rename"),
+        ("POST",   r"/containers/(?P<ref>[^/]+)/update",  "update"),
+        ("POST",   r"/containers/(?P<ref>[^/]+)/wait",    "wait"),
+        ("GET",    r"/containers/(?P<ref>[^/]+)/logs",    "logs"),
+        ("GET",    r"/containers/(?P<ref>[^/]+)/stats",   "stats"),
+        ("DELETE", r"/containers/(?P<ref>[^/]+)",         "remove_container"),
+        ("GET",    r"/images/json",                  "images"),
+        ("POST",   r"/images/create",                "pull"),
+        ("POST",   r"/images/load",                  "load"),
+        ("GET",    r"/images/(?P<ref>.+)/get",       "get_image"),
+        ("POST",   r"/images/(?P<ref>.+)/tag",       "tag"),
+        ("GET",    r"/images/(?P<ref>.+)/json",      "inspect_image"),
+        ("DELETE", r"/images/(?P<ref>.+)",           "remove_image"),
+    )
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def do_HEAD(self):
+        self.dispatch("HEAD")
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        path = re.sub(r"^/v[0-9.]+", "", url.path)
+        self.query = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        self.raw_body = self.read_body()
+        self.body = None
+        if "json" in (self.headers.get('Content-Type') or "") and self.raw_body.strip():
+            self.body = json.loads(self.raw_body.decode("utf-8"))
+
+        docker = self.server.docker
+        if docker.latency:
+            time.sleep(docker.latency)
+        for route_method, pattern, name in self.ROUTES:
+            match = re.match(pattern + "$", path)
+            if route_method == method and match:
+                docker.record("{0} {1}".format(method, name))
+                if docker.take_fault(name):
+                    self.send_json(500, {'message': "injected server error"})
+                    return
+                try:
+                    args = dict((k, unquote(v)) for k, v in match.groupdict().items())
+                    getattr(self, "handle_" + name)(docker, **args)
+                except NotFound as e:
+                    self.send_json(404, {'message': str(e)})
+                except Conflict as e:
+                    self.send_json(409, {'message': str(e)})
+                return
+        docker.record("{0} unknown".format(method))
+        self.send_json(404, {'message': "page not found"})
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+                if not size:
+                    return b"".join(chunks)
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b""
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8") if data is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, chunks, content_type = "application/json"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, dict):
+                    chunk = (json.dumps(chunk) + "\r\n").encode("utf-8")
+                self.wfile.write("{0:x}\r\n".format(len(chunk)).encode("ascii") + chunk + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        except (IOError, OSError):
+            # The client went away
+            self.close_connection = True
+
+    def flag(self, name):
+        return self.query.get(name) in ("1", "true", "True")
+
+    def handle_ping(self, docker):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"OK")
+
+    def handle_version(self, docker):
+        self.send_json(200, {'Version': "1.12.0", 'ApiVersion': "1.24", 'Os': "linux", 'Arch': "amd64"})
+
+    def handle_info(self, docker):
+        self.send_json(200, {'Containers': len(docker.containers), 'Images': len(docker.images), 'NCPU': 4})
+
+    def handle_events(self, docker):
+        since = float(self.query['since']) if self.query.get('since') else None
+        until = float(self.query['until']) if self.query.get('until') else None
+        filters = json.loads(self.query['filters']) if self.query.get('filters') else None
+        self.send_stream(docker.iter_events(since, until, filters))
+
+    def handle_containers(self, docker):
+        filters = json.loads(self.query['filters']) if self.query.get('filters') else None
+        self.send_json(200, docker.list_containers(self.flag('all'), filters))
+
+    def handle_create(self, docker):
+        c = docker.create_container(self.query.get('name'), self.body or {})
+        self.send_json(201, {'Id': c['Id'], 'Warnings': None})
+
+    def handle_inspect_container(self, docker, ref):
+        self.send_json(200, docker.find_container(ref))
+
+    def handle_start(self, docker, ref):
+        docker.start_container(ref, self.body)
+        self.send_json(204, None)
+
+    def handle_stop(self, docker, ref):
+        docker.stop_container(ref)
+        self.send_json(204, None)
+
+    def handle_restart(self, docker, ref):
+        docker.restart_container(ref)
+        self.send_json(204, None)
+
+    def handle_kill(self, docker, ref):
+        docker.stop_container(ref, self.query.get('signal') or "SIGKILL")
+        self.send_json(204, None)
+
+    def handle_rename(self, docker, ref):
+        docker.rename_container(ref, self.query['name'])
+        self.send_json(204, None)
+
+    def handle_update(self, docker, ref):
+        docker.update_container(ref, self.body or {})
+        self.send_json(200, {'Warnings': None})
+
+    def handle_wait(self, docker, ref):
+        self.send_json(200, docker.wait_container(ref))
+
+    def handle_logs(self, docker, ref):
+        tail = self.query.get('tail')
+        logs = docker.iter_logs(
+            ref, self.flag('stdout'), self.flag('stderr'),
+            int(tail) if tail and tail != "all" else None,
+            int(float(self.query.get('since') or 0)), int(float(self.query.get('until') or 0)),
+        )
+        tty = docker.find_container(ref)['Config']['Tty']
+        frames = (
+            data if tty else struct.pack(">BxxxL", 1 if name == "stdout" else 2, len(data)) + data
+            for name, data in logs
+        )
+        self.send_stream(frames, "application/vnd.docker.raw-stream")
+
+    def handle_stats(self, docker, ref):
+        self.send_stream(docker.iter_stats(ref))
+
+    def handle_remove_container(self, docker, ref):
+        docker.remove_container(ref, self.flag('force'))
+        self.send_json(204, None)
+
+    def handle_images(self, docker):
+        name = self.query.get('filter')
+        if self.query.get('filters'):
+            name = (json.loads(self.query['filters']).get('reference') or [name])[0]
+        self.send_json(200, docker.list_images(name))
+
+    def handle_pull(self, docker):
+        repo = self.query['fromImage']
+        tag = self.query.get('tag')
+        if not tag:
+            repo, tag = split_tag(repo)
+        self.send_stream(docker.pull(repo, tag))
+
+    def handle_inspect_image(self, docker, ref):
+        self.send_json(200, docker.inspect_image(ref))
+
+    def handle_load(self, docker):
+        docker.load_image(self.raw_body)
+        self.send_json(200, None)
+
+    def handle_get_image(self, docker, ref):
+        data = docker.save_image(ref)
+        self.send_stream((data[i:i + 65536] for i in range(0, len(data), 65536)), "application/x-tar")
+
+    def handle_tag(self, docker, ref):
+        docker.tag_image(ref, self.query['repo'], self.query.get('tag'))
+        self.send_json(201, None)
+
+    def handle_remove_image(self, docker, ref):
+        self.send_json(200, docker.remove_image(ref, self.flag('force')))
+
+class Server(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # Handlers log and format the client address as a tuple
+        request, _ = self.socket.accept()
+        return request, ("fake", 0)
+
+    def handle_error(self, request, client_address):
+        # Clients that give up in the middle of a request are expected
+        if not isinstance(sys.exc_info()[1], (IOError, OSError)):
+            UnixStreamServer.handle_error(self, request, client_address)
+
+class RegistryHandler(BaseHTTPRequestHandler):
+    """
+    Manifest endpoint of a registry, for the digest checks of image_latest.
+    The calls are counted with the calls of the daemon.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_manifest("HEAD")
+
+    def do_GET(self):
+        self.send_manifest("GET")
+
+    def send_manifest(self, method):
+        docker = self.server.docker
+        docker.record("{0} registry_manifest".format(method))
+        match = re.match(r"/v2/(?P<repo>.+)/manifests/(?P<ref>[^/]+)$", urlparse(self.path).path)
+        digest, manifest = None, None
+        if match:
+            repo = "{0}/{1}".format(self.server.host, match.group('repo'))
+            digest, manifest = docker.registry_manifest(repo, match.group('ref'))
+        if not manifest:
+            body = json.dumps({'errors': [{'code': "MANIFEST_UNKNOWN"}]}).encode("utf-8")
+            self.send_response(404)
+            self.send_header("Content-Type", "application/json")
+        else:
+            body = json.dumps(manifest).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", manifest['mediaType'])
+            self.send_header("Docker-Content-Digest", digest)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if method == "GET":
+            self.wfile.write(body)
+
+class RegistryServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # TLS handshakes of clients that try https first are expected
+        pass
+
+class FakeDaemon(object):
+    """
+    Runs the fake daemon and a registry for it in background threads.
+    """
+
+    def __init__(self, path, containers = 0, images = 0, latency = 0.0):
+        self.path = path
+        self.docker = FakeDocker(containers, images, latency)
+        self.server = None
+        self.thread = None
+        self.registry_server = None
+
+    @property
+    def url(self):
+        return "unix://{0}".format(self.path)
+
+    @property
+    def registry(self):
+        # Host of the registry, for image names like registry/repo:tag
+        return self.registry_server.host
+
+    @property
+    def calls(self):
+        return dict(self.docker.calls)
+
+    def reset_calls(self):
+        self.docker.reset_calls()
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = Server(self.path, Handler)
+        self.server.docker = self.docker
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.registry_server = RegistryServer(("127.0.0.1", 0), RegistryHandler)
+        self.registry_server.docker = self.docker
+        self.registry_server.host = "127.0.0.1:{0}".format(self.registry_server.server_address[1])
+        thread = threading.Thread(target = self.registry_server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.registry_server.shutdown()
+        self.registry_server.server_close()
+        self.server.shutdown()
+        self.server.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Fake Docker Engine API on a unix socket")
+    parser.add_argument("--socket", default = "/tmp/dockerimp-fake.sock")
+    parser.add_argument("--containers", type = int, default = 0)
+    parser.add_argument("--images", type = int, default = 0)
+    parser.add_argument("--latency", type = float, default = 0.0,
+            help = "Seconds to delay every request")
+    args = parser.parse_args()
+
+    daemon = FakeDaemon(args.socket, args.containers, args.images, args.latency).start()
+    print("Listening on {0}, registry on {1}".format(daemon.url, daemon.registry))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.stop()
+        for call, count in sorted(daemon.calls.items()):
+            print("{0:6} {1}".format(count, call))
+
+if __name__ == "__main__":
+    main()
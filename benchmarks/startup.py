@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""
+Measure the cold-start time of the dockerimp module for every state.
+
+Every state is run as a fresh python process the same way ansible runs the
+module, with the arguments in a JSON file. The wall time of the whole run is
+measured, and on python 3.7 and newer the import time of the heaviest
+modules is read from the output of -X importtime.
+
+    python benchmarks/startup.py --runs 10 --output startup.json
+    python benchmarks/startup.py --baseline startup.json --tolerance 20
+
+With --baseline the script exits with a non-zero status if the median wall
+time of any state is more than --tolerance percent slower than in the
+baseline. The script also exits with a non-zero status if any run fails,
+because a run that dies early would otherwise look like a fast start.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+MODULE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dockerimp.py")
+
+STATES = {
+    'present':          {'name': "bench", 'image': "busybox"},
+    'running':          {'name': "bench", 'image': "busybox"},
+    'running_latest':   {'name': "bench", 'image': "busybox"},
+    'stopped':          {'name': "bench"},
+    'absent':           {'name': "bench"},
+    'restarted':        {'name': "bench"},
+    'logs':             {'name': "bench", 'tail': 100},
+    'stats':            {'name': "bench", 'window': 1},
+    'image_present':    {'image': "busybox"},
+    'image_latest':     {'image': "busybox"},
+    'image_absent':     {'image': "busybox"},
+    'image_pruned':     {'image': "dockerimp-bench/*"},
+}
+
+# States that need the container to exist are run after running it once
+SETUP = {
+    'stopped':          'running',
+    'restarted':        'running',
+    'logs':             'running',
+    'stats':            'running',
+}
+
+# Top level imports whose cumulative import time is reported
+IMPORTS = ("docker", "ansible.module_utils.basic", "ssl", "urllib.request")
+
+def run_module(state, client_url, importtime):
+    """
+    Run the module once and return the wall time, the import times and the
+    error message if the run failed.
+    """
+    args = dict(STATES[state], state = state, client_url = client_url)
+    with tempfile.NamedTemporaryFile("w", suffix = ".json", delete = False) as f:
+        json.dump({'ANSIBLE_MODULE_ARGS': args}, f)
+    try:
+        command = [sys.executable]
+        if importtime:
+            command += ["-X", "importtime"]
+        command += [MODULE, f.name]
+        start = time.time()
+        process = subprocess.Popen(command, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        wall = time.time() - start
+        stderr = stderr.decode("utf-8", "replace")
+        return wall, parse_importtime(stderr), get_error(process.returncode, stdout.decode("utf-8", "replace"), stderr)
+    finally:
+        os.unlink(f.name)
+
+def get_error(returncode, stdout, stderr):
+    try:
+        result = json.loads(stdout)
+    except ValueError:
+        result = None
+    if isinstance(result, dict) and result.get('failed'):
+        return str(result.get('msg'))
+    if returncode or not isinstance(result, dict):
+        lines = [x for x in (stdout + stderr).splitlines() if x.strip() and not x.startswith("import time:")]
+        return "exit status {0}: {1}".format(returncode, lines[-1] if lines else "no output")
+    return None
+
+def parse_importtime(output):
+    # Lines look like "import time:   self [us] | cumulative | package"
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = [x.strip() for x in line[len("import time:"):].split("|")]
+        if len(fields) != 3 or not fields[1].isdigit():
+            continue
+        name = fields[2].strip()
+        if name in IMPORTS:
+            times[name] = max(times.get(name, 0), int(fields[1]) / 1000000.0)
+    return times
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def benchmark(states, runs, client_url):
+    importtime = sys.version_info >= (3, 7)
+    results = {}
+    for state in states:
+        walls = []
+        imports = {}
+        if state in SETUP:
+            _, _, error = run_module(SETUP[state], client_url, False)
+            if error:
+                results[state] = {'error': "setup failed, {0}".format(error)}
+                continue
+        for _ in range(runs):
+            wall, times, error = run_module(state, client_url, importtime)
+            if error:
+                break
+            walls.append(wall)
+            for name, value in times.items():
+                imports.setdefault(name, []).append(value)
+        if error:
+            results[state] = {'error': error}
+            continue
+        results[state] = {
+            'wall_median': round(median(walls), 4),
+            'wall_min': round(min(walls), 4),
+            'imports': dict((x, round(median(imports[x]), 4)) for x in imports),
+        }
+    return results
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for state, result in sorted(results.items()):
+        old = baseline.get(state)
+        if not old or 'wall_median' not in old or result.get('error'):
+            continue
+        limit = old['wall_median'] * (1 + tolerance / 100.0)
+        if result['wall_median'] > limit:
+            regressions.append("{0}: {1:.4f}s, baseline {2:.4f}s".format(
+                state, result['wall_median'], old['wall_median']))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description = "Measure dockerimp startup time per state")
+    parser.add_argument("--runs", type = int, default = 5)
+    parser.add_argument("--state", action = "append", choices = sorted(STATES),
+            help = "State to measure, may be given many times. Defaults to all states.")
+    parser.add_argument("--client-url", default = os.environ.get("DOCKER_HOST", "unix://var/run/docker.sock"))
+    parser.add_argument("--output", help = "Write the results to this JSON file")
+    parser.add_argument("--baseline", help = "Compare the results to this JSON file")
+    parser.add_argument("--tolerance", type = float, default = 20.0,
+            help = "Allowed slowdown against the baseline in percent")
+    args = parser.parse_args()
+
+    results = benchmark(args.state or sorted(STATES), args.runs, args.client_url)
+    for state, result in sorted(results.items()):
+        if result.get('error'):
+            print("{0:16} failed: {1}".format(state, result['error']))
+            continue
+        imports = " ".join("{0}={1:.4f}s".format(x, y) for x, y in sorted(result['imports'].items()))
+        print("{0:16} median {1:.4f}s min {2:.4f}s {3}".format(
+            state, result['wall_median'], result['wall_min'], imports))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent = 2, sort_keys = True)
+
+    failed = sorted(x for x in results if results[x].get('error'))
+    if failed:
+        print("Module runs failed: {0}".format(", ".join(failed)))
+        sys.exit(1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Startup time regressed:")
+            for i in regressions:
+                print("  " + i)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
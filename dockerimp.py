@@ -9,7 +9,8 @@ description:
 options:
     name:
         description:
-            - Set the name of the container
+            - Set the name of the container. The stats state also accepts
+              a list of names.
         required: false
         default: null
         aliases: ["id"]
@@ -20,13 +21,17 @@ options:
         default: null
         choices: [
             "present", "running", "stopped", "absent",
-            "restarted", "image_present", "image_latest",
-            "image_absent"
+            "restarted", "logs", "stats", "image_present", "image_latest",
+            "image_absent", "image_pruned", "image_loaded",
+            "image_saved"
         ]
         aliases: []
     image:
         description:
-            - Set the image for the container
+            - Set the image for the container. The image_present and
+              image_latest states also accept a list of images. With
+              image_pruned one or a list of repository patterns such as
+              "myorg/*", by default all repositories.
         required: false
         default: null
         aliases: []
@@ -66,42 +71,1504 @@ options:
         required: false
         default: null
         aliases: []
+    volumes_from:
+        description:
+            - Mount the volumes of these containers, a list or a comma
+              separated string of names with an optional ":ro" or ":rw"
+        required: false
+        default: null
+        aliases: []
+    mem_limit:
+        description:
+            - Memory limit, for example "512m". Can be changed without
+              recreating the container.
+        required: false
+        default: null
+        aliases: []
+    memswap_limit:
+        description:
+            - Total memory and swap limit. Can be changed without recreating
+              the container.
+        required: false
+        default: null
+        aliases: []
+    cpu_shares:
+        description:
+            - Relative CPU weight. Can be changed without recreating the
+              container.
+        required: false
+        default: null
+        aliases: []
+    cpuset:
+        description:
+            - CPUs the container may use, for example "0-2". Can be changed
+              without recreating the container.
+        required: false
+        default: null
+        aliases: []
+    blkio_weight:
+        description:
+            - Relative block IO weight. Can be changed without recreating the
+              container.
+        required: false
+        default: null
+        aliases: []
+    restart_policy:
+        description:
+            - Restart policy in form "always" or "on-failure:5". Can be
+              changed without recreating the container.
+        required: false
+        default: null
+        aliases: []
+    stop_timeout:
+        description:
+            - Seconds to wait for the container to exit when it is stopped
+              or restarted before it is killed
+        required: false
+        default: 10
+        aliases: []
+    stop_signal:
+        description:
+            - Signal used to stop the container, for example SIGINT. Also
+              set as the stop signal of created containers.
+        required: false
+        default: null
+        aliases: []
+    force_remove:
+        description:
+            - Kill and remove a running container in one call instead of
+              stopping it first
+        required: false
+        default: false
+        aliases: []
+    remove_volumes:
+        description:
+            - Remove the anonymous volumes of the container with it
+        required: false
+        default: false
+        aliases: []
+    wait:
+        description:
+            - Wait after starting or restarting the container until it is
+              running or until its health check reports it healthy. The
+              wait follows the docker events of the container and the time
+              it took is returned in time_to_ready.
+        required: false
+        default: null
+        choices: ["running", "healthy"]
+        aliases: []
+    wait_timeout:
+        description:
+            - Seconds to wait for the container with the wait option
+        required: false
+        default: 60
+        aliases: []
+    replace_strategy:
+        description:
+            - How a container is replaced when it has to be recreated.
+              stop_first removes the old container before the new one is
+              created. start_first starts the new container under a
+              temporary name, waits for it to be running or healthy and
+              only then removes the old container and renames the new one.
+              Containers that bind fixed host ports are always replaced
+              with stop_first.
+        required: false
+        default: "stop_first"
+        choices: ["stop_first", "start_first"]
+        aliases: []
+    replace_timeout:
+        description:
+            - Seconds to wait for the replacement to be ready with the
+              start_first strategy
+        required: false
+        default: 60
+        aliases: []
+    containers:
+        description:
+            - List of containers to manage in one run. Every item takes the
+              same options as a single container (name, image, env, volumes,
+              ports, command, state). Options not given in the item are
+              taken from the task. Containers are started after the
+              containers they link to or take volumes from.
+        required: false
+        default: null
+        aliases: []
+    parallelism:
+        description:
+            - Maximum number of containers handled or images pulled
+              concurrently
+        required: false
+        default: 4
+        aliases: []
+    profile:
+        description:
+            - Record the duration and response size of every docker API
+              call and return the counts and percentiles per call in the
+              profile key of the result
+        required: false
+        default: false
+        aliases: []
+    profile_dump:
+        description:
+            - Write cProfile statistics of the run to this file
+        required: false
+        default: null
+        aliases: []
+    helper:
+        description:
+            - Run the request in a long-lived helper process that keeps the
+              docker client and a container and image inventory between
+              tasks. The helper is started on first use and it exits after
+              helper_idle_timeout seconds without requests.
+        required: false
+        default: false
+        aliases: []
+    helper_socket:
+        description:
+            - Path of the unix socket of the helper. By default a socket
+              specific to client_url in a directory of the temp directory
+              that only the user can access. A socket that is not owned
+              by the user is refused.
+        required: false
+        default: null
+        aliases: []
+    helper_idle_timeout:
+        description:
+            - Seconds the helper waits for requests before exiting
+        required: false
+        default: 600
+        aliases: []
     client_url:
         description:
             - Client base url
         required: false
         default: "unix://var/run/docker.sock"
         aliases: []
+    tls:
+        description:
+            - Connect to the daemon with TLS
+        required: false
+        default: false
+        aliases: []
+    tls_verify:
+        description:
+            - Connect with TLS and verify the certificate of the daemon
+              against tls_ca_cert
+        required: false
+        default: false
+        aliases: []
+    tls_ca_cert:
+        description:
+            - Path of the CA certificate for verifying the daemon
+        required: false
+        default: null
+        aliases: []
+    tls_client_cert:
+        description:
+            - Path of the client certificate
+        required: false
+        default: null
+        aliases: []
+    tls_client_key:
+        description:
+            - Path of the key of the client certificate
+        required: false
+        default: null
+        aliases: []
+    tls_hostname:
+        description:
+            - Host name expected in the certificate of the daemon
+        required: false
+        default: null
+        aliases: []
+    hosts:
+        description:
+            - List of docker daemons to apply the task to from the
+              controller instead of the local daemon. An item is a
+              client_url or a dict of client_url and the tls options, which
+              default to the options of the task.
+        required: false
+        default: null
+        aliases: []
+    host_parallelism:
+        description:
+            - Maximum number of hosts handled concurrently
+        required: false
+        default: 20
+        aliases: []
+    max_failed_hosts:
+        description:
+            - Number of failed hosts that is tolerated. Once more hosts
+              have failed, the hosts that have not been started are
+              skipped and the task fails.
+        required: false
+        default: 0
+        aliases: []
+    connect_timeout:
+        description:
+            - Seconds to wait for the connection to the docker daemon
+        required: false
+        default: 5
+        aliases: []
+    read_timeout:
+        description:
+            - Seconds to wait for a response from the docker daemon
+        required: false
+        default: 60
+        aliases: []
+    retries:
+        description:
+            - Number of times a read such as listing or inspecting is
+              retried when the daemon fails with a server error or a
+              timeout. The retries wait an exponentially growing random
+              time. Calls that change something are retried only if the
+              connection could not be made.
+        required: false
+        default: 3
+        aliases: []
+    breaker_threshold:
+        description:
+            - Fail every call of the run right away once this many calls
+              to the daemon have failed in a row. 0 disables it.
+        required: false
+        default: 5
+        aliases: []
     insecure_registry:
         description:
             - Trust insecure registrys
         required: false
         default: false
         aliases: []
+    latest_image:
+        description:
+            - Pull the image if the registry has a newer one than the local
+              image and recreate the container if it is not running it
+        required: false
+        default: false
+        aliases: []
+    tail:
+        description:
+            - Number of the last log lines that the logs state reads, by
+              default all
+        required: false
+        default: null
+        aliases: []
+    since:
+        description:
+            - Read only logs written after this UNIX timestamp or duration
+              before now such as "10m"
+        required: false
+        default: null
+        aliases: []
+    until:
+        description:
+            - Read only logs written before this UNIX timestamp or duration
+              before now such as "10m". Needs docker API 1.35 or newer.
+        required: false
+        default: null
+        aliases: []
+    max_bytes:
+        description:
+            - Maximum size of the log lines that the logs state returns.
+              Reading stops when the next line does not fit.
+        required: false
+        default: "1m"
+        aliases: []
+    grep:
+        description:
+            - Return only the log lines that match this regular expression
+        required: false
+        default: null
+        aliases: []
+    label:
+        description:
+            - Label selector of the containers that the stats state
+              samples, such as "app=web" or a list of them
+        required: false
+        default: null
+        aliases: []
+    window:
+        description:
+            - Seconds that the stats state samples the containers for
+        required: false
+        default: 10
+        aliases: []
+    keep:
+        description:
+            - Number of the newest images of every repository that
+              image_pruned keeps even if no container uses them
+        required: false
+        default: 1
+        aliases: []
+    path:
+        description:
+            - Path of the docker save archive that image_loaded loads or
+              image_saved writes. image_saved records the sha256 of the
+              archive in a file with a .sha256 suffix.
+        required: false
+        default: null
+        aliases: []
 '''
+import os
 import sys
 import copy
-try:
-    import docker.client
-except ImportError as e:
-    print("Failed to import module {0}".format(e))
-    sys.exit(1)
+import fnmatch
+import hashlib
+import json
+import math
+import re
+import shlex
+import struct
+import threading
+import time
+
+# Modules that are needed only by some of the states are imported when they
+# are first used, so that simple tasks do not pay for importing them. See
+# benchmarks/startup.py.
+docker = None
+
+def import_docker():
+    global docker
+    if docker is None:
+        try:
+            import docker.client
+            import docker.errors
+        except ImportError as e:
+            print("Failed to import module {0}".format(e))
+            sys.exit(1)
+    return docker
 
 class ContainerManagerException(Exception):
     pass
 
+# Label holding the hash of the requested container spec. Containers
+# carrying the label can be checked for changes from the container listing.
+FINGERPRINT_LABEL = "dockerimp.fingerprint"
+
+# Options that can be changed on an existing container with the update API,
+# mapped to the matching argument of client.update_container
+LIVE_UPDATE_FIELDS = {
+    'mem_limit': 'mem_limit',
+    'memswap_limit': 'memswap_limit',
+    'cpu_shares': 'cpu_shares',
+    'cpuset': 'cpuset_cpus',
+    'blkio_weight': 'blkio_weight',
+    'restart_policy': 'restart_policy',
+}
+
+# Live update fields that are resource limits of the host config
+RESOURCE_FIELDS = ('mem_limit', 'memswap_limit', 'cpu_shares', 'cpuset', 'blkio_weight')
+
+def parse_bytes(value):
+    """
+    Convert a size such as "512m" to bytes.
+    """
+    if type(value) is int:
+        return value
+    units = {'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    value = str(value).strip().lower()
+    try:
+        if value[-1:] in units:
+            return int(value[:-1]) * units[value[-1]]
+        return int(value)
+    except ValueError:
+        raise ContainerManagerException({'Invalid size': value})
+
+def synchronized(method):
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def run_concurrently(func, items, limit):
+    """
+    Call func for every item using at most limit threads. Returns a list of
+    (result, exception) tuples in the same order as the items.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    pending = iter(range(len(items)))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                i = next(pending, None)
+            if i is None:
+                return
+            try:
+                results[i] = (func(items[i]), None)
+            except Exception as e:
+                results[i] = (None, e)
+
+    threads = [threading.Thread(target = worker) for _ in range(max(1, min(limit, len(items))))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def get_waves(dependencies):
+    """
+    Split a dependency graph, given as a dict of names to the names they
+    depend on, to waves so that every name comes after the names it depends
+    on. Dependencies that are not in the graph are expected to exist already.
+    """
+    remaining = dict((x, set(y) & set(dependencies)) for x, y in dependencies.items())
+    waves = []
+    while remaining:
+        wave = sorted(x for x in remaining if not remaining[x])
+        if not wave:
+            # Follow the dependencies until a name repeats to find a cycle
+            path = [sorted(remaining)[0]]
+            while path.count(path[-1]) < 2:
+                path.append(sorted(remaining[path[-1]])[0])
+            cycle = path[path.index(path[-1]):]
+            raise ContainerManagerException({'Dependency cycle': " -> ".join(cycle)})
+        waves.append(wave)
+        for name in wave:
+            del remaining[name]
+        for names in remaining.values():
+            names.difference_update(wave)
+    return waves
+
+def normalize_image_name(name):
+    """
+    Return the fully qualified form of an image reference so that for example
+    "ubuntu", "ubuntu:latest" and "docker.io/library/ubuntu:latest" compare
+    equal.
+    """
+    parts = name.split("/")
+    if len(parts) > 1 and ("." in parts[0] or ":" in parts[0] or parts[0] == "localhost"):
+        registry = parts[0]
+        parts = parts[1:]
+    else:
+        registry = "docker.io"
+    if registry in ("index.docker.io", "registry-1.docker.io"):
+        registry = "docker.io"
+    if registry == "docker.io" and len(parts) == 1:
+        parts = ["library"] + parts
+    if "@" not in parts[-1] and ":" not in parts[-1]:
+        parts[-1] = "{0}:latest".format(parts[-1])
+    return "/".join([registry] + parts)
+
+MANIFEST_MEDIA_TYPES = (
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.oci.image.manifest.v1+json",
+)
+
+def split_image_name(name):
+    """
+    Split an image reference to registry host, repository and tag or digest.
+    """
+    registry, repo = normalize_image_name(name).split("/", 1)
+    if "@" in repo:
+        repo, reference = repo.split("@", 1)
+    else:
+        repo, reference = repo.rsplit(":", 1)
+    if registry == "docker.io":
+        registry = "registry-1.docker.io"
+    return registry, repo, reference
+
+def get_registry_digest(name, insecure_registry = False, timeout = 10):
+    """
+    Ask the registry for the manifest digest of an image with a HEAD request.
+    Returns None if the registry cannot tell, in which case the caller should
+    fall back to pulling the image.
+    """
+    response = registry_manifest_request(name, "HEAD", insecure_registry, timeout)
+    if response is None:
+        return None
+    try:
+        return response.headers.get("Docker-Content-Digest")
+    finally:
+        response.close()
+
+def get_registry_download_size(name, architecture, insecure_registry = False, timeout = 10):
+    """
+    Return the compressed size of the layers and the config of an image from
+    its manifest, or None if the registry cannot tell. Layers that exist
+    locally are counted too, so the size is an upper bound of the download.
+    """
+    manifest = read_registry_manifest(name, None, insecure_registry, timeout)
+    if manifest and manifest.get('manifests'):
+        # Multi-platform image, the size is the one of the daemon's platform
+        digests = [
+            x['digest'] for x in manifest['manifests']
+            if (x.get('platform') or {}).get('os', "linux") == "linux" and
+                (x.get('platform') or {}).get('architecture') == architecture
+        ]
+        manifest = digests and read_registry_manifest(name, digests[0], insecure_registry, timeout)
+    if not manifest or not manifest.get('layers'):
+        # Schema 1 manifests do not have the sizes of the layers
+        return None
+    return sum(x.get('size') or 0 for x in manifest['layers']) + (manifest.get('config') or {}).get('size', 0)
+
+def read_registry_manifest(name, reference, insecure_registry, timeout):
+    response = registry_manifest_request(name, "GET", insecure_registry, timeout, reference)
+    if response is None:
+        return None
+    try:
+        return json.loads(response.read().decode("utf-8"))
+    except ValueError:
+        return None
+    finally:
+        response.close()
+
+def registry_manifest_request(name, method, insecure_registry, timeout, reference = None):
+    """
+    Send a request for the manifest of an image to its registry. Returns the
+    response, or None if the registry cannot be reached or refuses.
+    """
+    import ssl
+    try:
+        from urllib.request import HTTPError, URLError
+    except ImportError:
+        from urllib2 import HTTPError, URLError
+
+    registry, repo, tag = split_image_name(name)
+    schemes = ("https", "http") if insecure_registry else ("https",)
+    context = None
+    if insecure_registry:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+
+    for scheme in schemes:
+        url = "{0}://{1}/v2/{2}/manifests/{3}".format(scheme, registry, repo, reference or tag)
+        try:
+            return registry_request(url, method, context, timeout)
+        except HTTPError:
+            return None
+        except URLError:
+            continue
+    return None
+
+def registry_request(url, method, context, timeout, token = None):
+    try:
+        from urllib.request import Request, HTTPError, urlopen
+        from urllib.parse import urlencode
+    except ImportError:
+        from urllib2 import Request, HTTPError, urlopen
+        from urllib import urlencode
+
+    request = Request(url, headers = {'Accept': ", ".join(MANIFEST_MEDIA_TYPES)})
+    request.get_method = lambda: method
+    if token:
+        request.add_header("Authorization", "Bearer {0}".format(token))
+    try:
+        return urlopen(request, timeout = timeout, context = context)
+    except HTTPError as e:
+        challenge = e.headers.get("WWW-Authenticate") or ""
+        if e.code != 401 or token or not challenge.startswith("Bearer"):
+            raise
+        # Anonymous token for registries that require one even for public
+        # images, like Docker Hub
+        fields = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = fields.pop('realm', None)
+        if not realm:
+            raise
+        response = urlopen("{0}?{1}".format(realm, urlencode(fields)), timeout = timeout, context = context)
+        body = json.loads(response.read().decode("utf-8"))
+        return registry_request(url, method, context, timeout, body.get('token') or body.get('access_token'))
+
+def get_local_digest(image, name):
+    """
+    Return the digest of the image that was pulled from the repository of
+    the given image name, or None if the image has not been pulled by tag.
+    """
+    registry, repo = normalize_image_name(name).split("/", 1)
+    repo = "/".join([registry, re.split(r"[:@]", repo)[0]])
+    for i in (image or {}).get('RepoDigests') or []:
+        digest_repo, digest = i.split("@", 1)
+        if normalize_image_name(digest_repo).rsplit(":", 1)[0] == repo:
+            return digest
+    return None
+
+def get_image_repositories(image):
+    """
+    Return the repositories of an image from its tags and digests. An image
+    that lost its tag to a newer pull still has the digest of the repository
+    it was pulled from.
+    """
+    repos = set()
+    for tag in image.get('RepoTags') or []:
+        if tag != "<none>:<none>":
+            repos.add(tag.rsplit(":", 1)[0])
+    for digest in image.get('RepoDigests') or []:
+        if digest != "<none>@<none>":
+            repos.add(digest.split("@", 1)[0])
+    return repos
+
+ARCHIVE_CHUNK_SIZE = 1024 * 1024
+
+def read_image_archive(path):
+    """
+    Return the images in an archive made by docker save as a list of
+    (image id, repo tags) tuples. The ids of old archives that have only a
+    repositories file are not content addressable and never match a local
+    image.
+    """
+    import tarfile
+    try:
+        with tarfile.open(path) as archive:
+            names = archive.getnames()
+            if "manifest.json" in names:
+                manifest = json.loads(archive.extractfile("manifest.json").read().decode("utf-8"))
+                return [
+                    ("sha256:" + os.path.basename(x['Config']).split(".")[0], x.get('RepoTags') or [])
+                    for x in manifest
+                ]
+            if "repositories" in names:
+                images = {}
+                repositories = json.loads(archive.extractfile("repositories").read().decode("utf-8"))
+                for repo, tags in repositories.items():
+                    for tag, image_id in tags.items():
+                        images.setdefault(image_id, []).append("{0}:{1}".format(repo, tag))
+                return sorted(images.items())
+    except (IOError, OSError, ValueError, tarfile.TarError):
+        raise ContainerManagerException({'Invalid archive': path})
+    raise ContainerManagerException({'Invalid archive': "{0}: no manifest".format(path)})
+
+class ChecksumReader():
+    """
+    File object that computes the sha256 of what is read from it. With a
+    checksum the sha256 is compared to it before the last chunk is returned,
+    so that a corrupt file is never sent whole.
+    """
+
+    def __init__(self, path, checksum = None):
+        self.path = path
+        self.checksum = checksum
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.digest = hashlib.sha256()
+
+    def __len__(self):
+        # Lets requests send the size of the file as the content length
+        return self.size
+
+    def read(self, size = -1):
+        chunk = self.file.read(size)
+        self.digest.update(chunk)
+        if self.checksum and self.file.tell() >= self.size and self.hexdigest() != self.checksum:
+            raise ContainerManagerException({'Checksum mismatch': self.path})
+        return chunk
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+    def close(self):
+        self.file.close()
+
+def get_file_checksum(path):
+    reader = ChecksumReader(path)
+    try:
+        while reader.read(ARCHIVE_CHUNK_SIZE):
+            pass
+    finally:
+        reader.close()
+    return reader.hexdigest()
+
+def read_checksum(path):
+    """
+    Return the checksum recorded for a file in the sha256sum format file
+    next to it, or None if there is none.
+    """
+    try:
+        with open(path + ".sha256") as f:
+            return f.read().split()[0]
+    except (IOError, OSError, IndexError):
+        return None
+
+def write_checksum(path, checksum):
+    with open(path + ".sha256", "w") as f:
+        f.write("{0}  {1}\n".format(checksum, os.path.basename(path)))
+
+def parse_time(value):
+    """
+    Convert a UNIX timestamp or a duration before now such as "10m" to a
+    UNIX timestamp.
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    value = str(value).strip().lower()
+    try:
+        if value[-1:] in units:
+            return int(time.time() - float(value[:-1]) * units[value[-1]])
+        return int(float(value))
+    except ValueError:
+        raise ContainerManagerException({'Invalid time': value})
+
+LOG_CHUNK_SIZE = 64 * 1024
+LOG_STREAMS = {1: "stdout", 2: "stderr"}
+
+def read_exactly(stream, size):
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+def iter_log_chunks(stream, tty):
+    """
+    Yield (stream name, data) tuples from a log stream of the docker API.
+    The logs of containers without a tty come in frames that start with an
+    8 byte header of the stream type and the size of the payload.
+    """
+    if tty:
+        for data in iter(lambda: stream.read(LOG_CHUNK_SIZE), b""):
+            yield "stdout", data
+        return
+    while True:
+        header = read_exactly(stream, 8)
+        if len(header) < 8:
+            return
+        stream_type, size = struct.unpack(">BxxxL", header)
+        name = LOG_STREAMS.get(stream_type, "stdout")
+        while size:
+            data = stream.read(min(size, LOG_CHUNK_SIZE))
+            if not data:
+                return
+            size -= len(data)
+            yield name, data
+
+def iter_log_lines(stream, tty, limit):
+    """
+    Yield (stream name, line) tuples from a log stream. A line longer than
+    limit is cut, so that no more than limit bytes are buffered per stream.
+    """
+    partial = {'stdout': b"", 'stderr': b""}
+    for name, data in iter_log_chunks(stream, tty):
+        lines = (partial[name] + data).split(b"\n")
+        partial[name] = lines.pop()
+        if len(partial[name]) > limit:
+            lines.append(partial[name][:limit + 1])
+            partial[name] = b""
+        for line in lines:
+            yield name, line.rstrip(b"\r")
+    for name in sorted(partial):
+        if partial[name]:
+            yield name, partial[name]
+
+def read_logs(stream, tty, max_bytes, grep = None):
+    """
+    Collect the lines of a log stream that match grep until the stream ends
+    or the lines would take more than max_bytes. The rest of the stream is
+    not read.
+    """
+    result = {'stdout': [], 'stderr': [], 'lines': 0, 'bytes': 0, 'truncated': False}
+    for name, line in iter_log_lines(stream, tty, max_bytes):
+        line = line.decode("utf-8", "replace")
+        if grep and not grep.search(line):
+            continue
+        size = len(line.encode("utf-8")) + 1
+        if result['bytes'] + size > max_bytes:
+            result['truncated'] = True
+            break
+        result[name].append(line)
+        result['lines'] += 1
+        result['bytes'] += size
+    result['stdout'] = "\n".join(result['stdout'])
+    result['stderr'] = "\n".join(result['stderr'])
+    return result
+
+def decode_json_stream(stream):
+    """
+    Yield the JSON objects of a streamed response one at a time. Only the
+    part of the stream that does not yet form a whole object is buffered.
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    for chunk in stream:
+        if isinstance(chunk, dict):
+            yield chunk
+            continue
+        if not isinstance(chunk, str):
+            chunk = chunk.decode("utf-8")
+        buf += chunk
+        while True:
+            buf = buf.lstrip()
+            if not buf:
+                break
+            try:
+                obj, end = decoder.raw_decode(buf)
+            except ValueError:
+                break
+            buf = buf[end:]
+            yield obj
+
+class PullProgress():
+    """
+    Compact per layer summary of a streamed pull.
+    """
+
+    LAYER_STATUSES = (
+        "Pulling fs layer", "Waiting", "Downloading", "Verifying Checksum",
+        "Download complete", "Extracting", "Pull complete", "Already exists",
+    )
+
+    def __init__(self):
+        self.layers = {}
+        self.order = []
+
+    def update(self, event):
+        if event.get('error'):
+            error = (event.get('errorDetail') or {}).get('message') or event['error']
+            raise ContainerManagerException({'Pull failed': error})
+
+        layer_id = event.get('id')
+        status = event.get('status') or ""
+        if not layer_id or not status.startswith(self.LAYER_STATUSES):
+            return
+
+        now = time.time()
+        layer = self.layers.get(layer_id)
+        if not layer:
+            layer = {'id': layer_id, 'bytes': 0, 'start': now, 'end': now, 'status': "downloaded"}
+            self.layers[layer_id] = layer
+            self.order.append(layer_id)
+        total = (event.get('progressDetail') or {}).get('total')
+        if total:
+            layer['bytes'] = max(layer['bytes'], total)
+        if status == "Already exists":
+            layer['status'] = "exists"
+        layer['end'] = now
+
+    def summary(self):
+        layers = []
+        for layer_id in self.order:
+            layer = self.layers[layer_id]
+            layers.append({
+                'id': layer_id,
+                'bytes': layer['bytes'],
+                'duration': round(layer['end'] - layer['start'], 3),
+                'status': layer['status'],
+            })
+        return layers
+
+IMAGE_EVENTS = ("pull", "push", "tag", "untag", "delete", "import", "load", "save")
+
+class StatsAggregate():
+    """
+    Running aggregates of the samples of a container stats stream. Only the
+    first and the previous sample's counters are kept, not the samples.
+    """
+
+    def __init__(self):
+        self.samples = 0
+        self.first = None
+        self.previous = None
+        self.cpu_max = 0.0
+        self.memory_total = 0
+        self.memory_peak = 0
+        self.memory_limit = 0
+
+    def counters(self, sample):
+        cpu_stats = sample.get('cpu_stats') or {}
+        cpu_usage = cpu_stats.get('cpu_usage') or {}
+        networks = sample.get('networks') or {}
+        if not networks and sample.get('network'):
+            # API versions before 1.21 report only one network
+            networks = {'eth0': sample['network']}
+        blkio = (sample.get('blkio_stats') or {}).get('io_service_bytes_recursive') or []
+        return {
+            'cpu': cpu_usage.get('total_usage') or 0,
+            'system': cpu_stats.get('system_cpu_usage') or 0,
+            'cpus': cpu_stats.get('online_cpus') or len(cpu_usage.get('percpu_usage') or []) or 1,
+            'rx_bytes': sum(x.get('rx_bytes') or 0 for x in networks.values()),
+            'tx_bytes': sum(x.get('tx_bytes') or 0 for x in networks.values()),
+            'read_bytes': sum(x.get('value') or 0 for x in blkio if (x.get('op') or "").lower() == "read"),
+            'write_bytes': sum(x.get('value') or 0 for x in blkio if (x.get('op') or "").lower() == "write"),
+        }
+
+    def cpu_percent(self, old, new):
+        system = new['system'] - old['system']
+        if system <= 0:
+            return 0.0
+        return 100.0 * (new['cpu'] - old['cpu']) / system * new['cpus']
+
+    def update(self, sample):
+        counters = self.counters(sample)
+        memory = sample.get('memory_stats') or {}
+        # The page cache can be dropped, so it is not counted as used like
+        # docker stats does
+        usage = (memory.get('usage') or 0) - ((memory.get('stats') or {}).get('cache') or 0)
+
+        self.samples += 1
+        self.memory_total += usage
+        self.memory_peak = max(self.memory_peak, usage)
+        self.memory_limit = memory.get('limit') or self.memory_limit
+        if self.previous:
+            self.cpu_max = max(self.cpu_max, self.cpu_percent(self.previous, counters))
+        else:
+            self.first = counters
+        self.previous = counters
+
+    def summary(self):
+        if not self.samples:
+            return {'samples': 0}
+        first, last = self.first, self.previous
+        return {
+            'samples': self.samples,
+            'cpu_percent': {
+                'avg': round(self.cpu_percent(first, last), 2),
+                'max': round(self.cpu_max, 2),
+            },
+            'memory': {
+                'avg': self.memory_total // self.samples,
+                'peak': self.memory_peak,
+                'limit': self.memory_limit,
+            },
+            'network': dict((x, last[x] - first[x]) for x in ('rx_bytes', 'tx_bytes')),
+            'blkio': dict((x, last[x] - first[x]) for x in ('read_bytes', 'write_bytes')),
+        }
+
+def get_update_arguments(client):
+    """
+    Return the names of the arguments that update_container of the docker-py
+    client takes. Some docker-py versions cannot update every field, for
+    example restart_policy.
+    """
+    import inspect
+    while isinstance(client, (ResilientClient, ProfilingClient)):
+        client = client.client
+    method = getattr(client, 'update_container', None)
+    if method is None:
+        return ()
+    if hasattr(inspect, 'signature'):
+        return tuple(inspect.signature(method).parameters)
+    # The decorators of docker-py hide the arguments from getargspec on
+    # python 2, so the docker-py version tells instead
+    if import_docker().version_info >= (2,):
+        return tuple(LIVE_UPDATE_FIELDS.values())
+    return tuple(x for x in LIVE_UPDATE_FIELDS.values() if x != 'restart_policy')
+
+def percentile(values, percent):
+    # Nearest rank percentile of sorted values
+    if not values:
+        return None
+    rank = max(0, int(math.ceil(percent * len(values) / 100.0)) - 1)
+    return values[min(rank, len(values) - 1)]
+
+class ProfilingClient():
+    """
+    Wraps a docker client and records the duration and the response size of
+    the API calls made through it.
+    """
+
+    PROFILED_CALLS = (
+        'containers', 'images', 'inspect_container', 'inspect_image',
+        'pull', 'create_container', 'start', 'stop', 'remove_container',
+        'restart', 'kill', 'rename', 'update_container', 'remove_image',
+        'wait', 'events', 'load_image', 'get_image', 'tag', 'version',
+    )
+
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+        self.records = {}
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name not in self.PROFILED_CALLS:
+            return attr
+
+        def call(*args, **kwargs):
+            start = time.time()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception:
+                self.record(name, start, 0)
+                raise
+            if hasattr(result, 'read'):
+                return ProfiledReader(self, name, start, result)
+            if hasattr(result, '__next__') or hasattr(result, 'next'):
+                return self.profile_stream(name, start, result)
+            self.record(name, start, self.response_size(result))
+            return result
+        return call
+
+    def profile_stream(self, name, start, stream):
+        size = 0
+        try:
+            for chunk in stream:
+                size += self.response_size(chunk)
+                yield chunk
+        finally:
+            self.record(name, start, size)
+
+    def record_response(self, name, start, response):
+        # Streams read directly through _get do not go through __getattr__,
+        # so they are recorded with the bytes read from the raw response
+        try:
+            size = response.raw.tell()
+        except (AttributeError, IOError):
+            size = 0
+        self.record(name, start, size)
+
+    def response_size(self, result):
+        if result is None:
+            return 0
+        if isinstance(result, (bytes, str)):
+            return len(result)
+        return len(json.dumps(result))
+
+    def record(self, name, start, size):
+        with self.lock:
+            durations, sizes = self.records.setdefault(name, ([], []))
+            durations.append(time.time() - start)
+            sizes.append(size)
+
+    def summary(self, clear = False):
+        with self.lock:
+            summary = {}
+            records = self.records
+            if clear:
+                self.records = {}
+            for name, (durations, sizes) in records.items():
+                durations = sorted(durations)
+                summary[name] = {
+                    'count': len(durations),
+                    'total': round(sum(durations), 6),
+                    'p50': round(percentile(durations, 50), 6),
+                    'p90': round(percentile(durations, 90), 6),
+                    'p99': round(percentile(durations, 99), 6),
+                    'max': round(durations[-1], 6),
+                    'bytes': sum(sizes),
+                }
+            return summary
+
+def create_client(params):
+    """
+    Create a docker client with the TLS settings and the connect and read
+    timeouts of the params.
+    """
+    docker = import_docker()
+    tls = False
+    if params.get('tls') or params.get('tls_verify'):
+        client_cert = None
+        if params.get('tls_client_cert'):
+            client_cert = (params['tls_client_cert'], params.get('tls_client_key'))
+        tls = docker.tls.TLSConfig(
+            client_cert = client_cert,
+            ca_cert = params.get('tls_ca_cert'),
+            verify = bool(params.get('tls_verify')),
+            assert_hostname = params.get('tls_hostname'),
+        )
+    client = docker.Client(base_url = params.get('client_url'), timeout = params.get('read_timeout') or 60, tls = tls)
+    connect_timeout = params.get('connect_timeout')
+    if connect_timeout:
+        # docker-py takes a single timeout and adds to it for some calls, so
+        # the connect timeout is added to the timeout of every request
+        set_request_timeout = client._set_request_timeout
+
+        def with_connect_timeout(kwargs):
+            kwargs = set_request_timeout(kwargs)
+            if not isinstance(kwargs.get('timeout'), tuple):
+                kwargs['timeout'] = (connect_timeout, kwargs.get('timeout'))
+            return kwargs
+        client._set_request_timeout = with_connect_timeout
+    return client
+
+class ProfiledReader():
+    """
+    Wraps a raw response returned by a profiled call, for example the archive
+    of get_image, and records the call once the response has been read to
+    the end or closed.
+    """
+
+    def __init__(self, profiler, name, start, raw):
+        self.profiler = profiler
+        self.name = name
+        self.start = start
+        self.raw = raw
+        self.size = 0
+        self.done = False
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def read(self, *args, **kwargs):
+        data = self.raw.read(*args, **kwargs)
+        self.size += len(data)
+        if not data:
+            self.finish()
+        return data
+
+    def close(self):
+        self.finish()
+        self.raw.close()
+
+    def finish(self):
+        if not self.done:
+            self.done = True
+            self.profiler.record(self.name, self.start, self.size)
+
+class ResilientClient():
+    """
+    Wraps a docker client to retry reads that fail because the daemon is
+    busy, and to fail fast once the daemon has failed too many times in a
+    row during a run.
+
+    Only idempotent reads are retried. Calls that change something are
+    retried only if the connection could not be made, because then the
+    request was never sent.
+    """
+
+    RETRIED_CALLS = (
+        'containers', 'images', 'inspect_container', 'inspect_image',
+        'version', 'info', 'ping',
+    )
+    # Calls whose read timeouts are expected, for example when waiting for a
+    # container that does not exit in time
+    LONG_CALLS = ('wait', 'events', 'logs', 'stats', 'attach')
+
+    RETRY_BASE_DELAY = 0.5
+    RETRY_MAX_DELAY = 8.0
+
+    def __init__(self, client, retries = 3, threshold = 5):
+        self.client = client
+        self.retries = retries
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.last_error = None
+        self.retried = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            attempt = 0
+            while True:
+                self.check()
+                try:
+                    result = attr(*args, **kwargs)
+                except Exception as e:
+                    if not self.is_daemon_error(name, e):
+                        raise
+                    self.failed(e)
+                    if attempt >= self.retries or not (name in self.RETRIED_CALLS or self.is_connect_error(e)):
+                        raise
+                    self.backoff(attempt)
+                    attempt += 1
+                    continue
+                self.succeeded()
+                return result
+        return call
+
+    def is_daemon_error(self, name, error):
+        import requests
+        if isinstance(error, requests.exceptions.ReadTimeout) and name in self.LONG_CALLS:
+            return False
+        if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return True
+        response = getattr(error, 'response', None)
+        return isinstance(error, import_docker().errors.APIError) and \
+            response is not None and response.status_code >= 500
+
+    def is_connect_error(self, error):
+        import requests
+        return isinstance(error, requests.exceptions.ConnectTimeout)
+
+    def backoff(self, attempt):
+        # Full jitter, so that concurrent calls do not retry in lockstep
+        import random
+        with self.lock:
+            self.retried += 1
+        time.sleep(random.uniform(0, min(self.RETRY_MAX_DELAY, self.RETRY_BASE_DELAY * 2 ** attempt)))
+
+    def check(self):
+        with self.lock:
+            if self.threshold and self.failures >= self.threshold:
+                error_msg = "{0} failed calls in a row, last error: {1}".format(self.failures, self.last_error)
+                raise ContainerManagerException({'Docker daemon unavailable': error_msg})
+
+    def failed(self, error):
+        with self.lock:
+            self.failures += 1
+            self.last_error = error
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+
+    def reset(self):
+        with self.lock:
+            self.failures = 0
+            self.last_error = None
+            self.retried = 0
+
+def is_id_prefix(name):
+    # Names shorter than 10 characters are never taken for an ID
+    return len(name) > 9 and re.match(r"^[0-9a-f]+$", name) is not None
+
+class Inventory():
+    """
+    Snapshot of the containers and images on the docker host.
+
+    Containers are indexed by name and by id and images by repo tag, so that
+    lookups during a run do not need to list everything from the daemon again.
+    The index is kept up to date from the results of the calls the module
+    makes itself instead of re-listing.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.RLock()
+        self.containers = {}
+        self.container_names = {}
+        self.container_details = {}
+        self.containers_loaded = False
+        self.queried_names = set()
+        self.stale_names = set()
+        self.images = {}
+        self.image_tags = {}
+        self.images_loaded = False
+        self.version = None
+
+    @synchronized
+    def load_containers(self):
+        if self.containers_loaded:
+            return
+        for c in self.client.containers(all = True):
+            self.add_container(c)
+        self.containers_loaded = True
+
+    @synchronized
+    def load_images(self):
+        if self.images_loaded:
+            return
+        for i in self.client.images():
+            self.add_image(i)
+        self.images_loaded = True
+
+    def query_containers(self, filters):
+        # Server side filtering is used when only a few containers are needed
+        # so that hosts with a lot of containers do not have to be listed whole
+        return self.client.containers(all = True, filters = filters)
+
+    @synchronized
+    def add_container(self, container):
+        container_id = container['Id']
+        old = self.containers.get(container_id)
+        if old:
+            for name in old.get('Names') or []:
+                self.container_names.pop(name.lstrip("/"), None)
+        self.containers[container_id] = container
+        for name in container.get('Names') or []:
+            self.container_names[name.lstrip("/")] = container_id
+
+    @synchronized
+    def update_container(self, info):
+        # Keep the listing entry in sync with the inspect result
+        container_id = info['Id']
+        summary = dict(self.containers.get(container_id) or {'Id': container_id})
+        summary['Names'] = [info['Name']]
+        summary['Image'] = info['Config']['Image']
+        summary['ImageID'] = info['Image']
+        summary['Labels'] = info['Config'].get('Labels') or {}
+        summary['State'] = "running" if info['State']['Running'] else "exited"
+        summary.pop('Status', None)
+        self.add_container(summary)
+        self.container_details[container_id] = info
+
+    @synchronized
+    def remove_container(self, container_id):
+        container = self.containers.pop(container_id, None)
+        self.container_details.pop(container_id, None)
+        if container:
+            for name in container.get('Names') or []:
+                self.container_names.pop(name.lstrip("/"), None)
+
+    @synchronized
+    def find_containers(self, name):
+        if (not self.containers_loaded and name not in self.queried_names) or name in self.stale_names:
+            for c in self.query_containers({'name': name}):
+                self.add_container(c)
+            if is_id_prefix(name):
+                for c in self.query_containers({'id': name}):
+                    self.add_container(c)
+            self.queried_names.add(name)
+            self.stale_names.discard(name)
+
+        found = set()
+        if name in self.container_names:
+            found.add(self.container_names[name])
+        if is_id_prefix(name):
+            found.update(x for x in self.containers if x.startswith(name))
+        return list(found)
+
+    @synchronized
+    def invalidate(self, event = None):
+        """
+        Forget what may have been changed by a docker event, or everything if
+        no event is given.
+        """
+        if event is None:
+            self.containers = {}
+            self.container_names = {}
+            self.container_details = {}
+            self.containers_loaded = False
+            self.queried_names = set()
+            self.stale_names = set()
+            self.images = {}
+            self.image_tags = {}
+            self.images_loaded = False
+            return
+
+        status = event.get('status') or event.get('Action') or ""
+        event_type = event.get('Type')
+        if not event_type:
+            # Older API versions do not tell the type of the event
+            event_type = "image" if status in IMAGE_EVENTS else "container"
+
+        if event_type == "image":
+            self.images = {}
+            self.image_tags = {}
+            self.images_loaded = False
+        elif event_type == "container" and not status.startswith("exec_"):
+            container_id = event.get('id')
+            attributes = (event.get('Actor') or {}).get('Attributes') or {}
+            summary = self.containers.get(container_id)
+            names = [x.lstrip("/") for x in (summary or {}).get('Names') or []]
+            names.extend(attributes[x].lstrip("/") for x in ('name', 'oldName') if attributes.get(x))
+            if not names:
+                # A new container whose name is not known, so the names have
+                # to be looked up from the daemon again
+                self.containers_loaded = False
+                self.queried_names = set()
+            self.remove_container(container_id)
+            self.stale_names.update(names)
+
+    @synchronized
+    def get_container_summary(self, container_id):
+        return self.containers.get(container_id)
+
+    @synchronized
+    def get_container_details(self, container_id):
+        return self.container_details.get(container_id)
+
+    @synchronized
+    def add_image(self, image):
+        self.images[image['Id']] = image
+        for tag in image.get('RepoTags') or []:
+            self.image_tags[tag] = image['Id']
+            self.image_tags[normalize_image_name(tag)] = image['Id']
+
+    @synchronized
+    def remove_image(self, image_id):
+        image = self.images.pop(image_id, None)
+        if image:
+            for tag in image.get('RepoTags') or []:
+                for key in (tag, normalize_image_name(tag)):
+                    if self.image_tags.get(key) == image_id:
+                        del self.image_tags[key]
+
+    @synchronized
+    def get_images(self):
+        self.load_images()
+        return dict(self.images)
+
+    @synchronized
+    def get_used_images(self):
+        """
+        Return the ids of the images used by any container, running or
+        stopped.
+        """
+        self.load_containers()
+        used = set()
+        for c in self.containers.values():
+            # Listings of old API versions have only the image name
+            used.add(c.get('ImageID') or self.image_tags.get(c.get('Image')) or c.get('Image'))
+        return used
+
+    @synchronized
+    def reload_images(self):
+        # Tags may move from one image to another when pulled so the index is
+        # built again from one bulk listing
+        self.images = {}
+        self.image_tags = {}
+        self.images_loaded = False
+        self.load_images()
+
+    @synchronized
+    def find_image(self, name):
+        if not self.images_loaded:
+            self.load_images()
+        image_id = self.image_tags.get(name) or self.image_tags.get(normalize_image_name(name))
+        if not image_id and name in self.images:
+            image_id = name
+        if image_id:
+            return self.images[image_id]
+        return None
+
+    @synchronized
+    def get_version(self):
+        if self.version is None:
+            self.version = self.client.version()
+        return self.version
+
 class ContainerManager():
 
-    def __init__(self, module):
+    def __init__(self, module, params = None, client = None, inventory = None):
         self.module = module
-        self.client = docker.Client(base_url = module.params.get('client_url'))
+        self.client = client or create_client(module.params)
+        if not isinstance(self.client, (ResilientClient, ProfilingClient)):
+            self.client = ResilientClient(self.client, module.params.get('retries') or 0, module.params.get('breaker_threshold'))
+        if (params or module.params).get('profile') and not isinstance(self.client, ProfilingClient):
+            self.client = ProfilingClient(self.client)
+        self.inventory = inventory or Inventory(self.client)
         self.changed = False
         self.check_mode = module.check_mode
         self.changes_made = []
-        self.params = self.fix_parameters()
+        self.container_results = None
+        self.image_results = {}
+        self.prune_results = None
+        self.archive_results = None
+        self.log_results = None
+        self.stats_results = None
+        self.recreated = False
+        self.drift = []
+        self.time_to_ready = None
+        self.params = self.fix_parameters(params)
+
+    def fix_parameters(self, params = None):
+        params = copy.deepcopy(self.module.params if params is None else params)
+
+        state = params.get('state')
+        for option, states in LIST_OPTIONS.items():
+            value = params.get(option)
+            if type(value) is list:
+                if state not in states:
+                    raise ContainerManagerException({'Invalid argument': value})
+                params[option] = [x if hasattr(x, "split") else str(x) for x in value]
+            elif type(value) is dict:
+                raise ContainerManagerException({'Invalid argument': value})
+            elif value is not None and not hasattr(value, "split"):
+                params[option] = str(value)
+
+        # Only parse the options the requested state uses
+        if state in NAME_ONLY_STATES:
+            return params
+
+        # image_pruned takes repository patterns instead of images
+        if params.get('image') and state != "image_pruned":
+            # add 'latest' tag to the image name if no tag is already provided
+            if type(params['image']) is list:
+                params['image'] = [self.add_default_tag(x) for x in params['image']]
+            else:
+                params['image'] = self.add_default_tag(params['image'])
+
+        if state in IMAGE_STATES:
+            return params
 
-    def fix_parameters(self):
-        params = copy.deepcopy(self.module.params)
         if params.get('volumes'):
             try:
                 if type(params['volumes']) is str:
@@ -134,13 +1601,6 @@ class ContainerManager():
             except IndexError as e:
                 raise ContainerManagerException({'Invalid argument': params['volumes']})
 
-        if params.get('image'):
-            # add 'latest' tag to the image name if no tag is already provided
-            image = params['image']
-            image_split = image.split("/")[-1].split(":")
-            if len(image_split) == 1:
-                params['image'] = "{0}:latest".format(params['image'])
-
         if params.get('ports'):
             try:
                 if type(params['ports']) is str:
@@ -213,12 +1673,243 @@ class ContainerManager():
 
             params['environment'] = envs
 
+        if params.get('links'):
+            if type(params['links']) is str:
+                link_params = params['links'].split(",")
+            elif type(params['links']) is list:
+                link_params = params['links']
+            elif type(params['links']) is dict:
+                link_params = ["{0}:{1}".format(x, params['links'][x]) for x in params['links']]
+            else:
+                raise ContainerManagerException({'Invalid argument': params['links']})
+
+            links = {}
+            for i in link_params:
+                values = i.split(":")
+                if len(values) > 2 or not values[0]:
+                    raise ContainerManagerException({'Invalid argument': params['links']})
+                links[values[0]] = values[-1]
+            params['links'] = links
+
+        if params.get('volumes_from'):
+            if type(params['volumes_from']) is str:
+                params['volumes_from'] = params['volumes_from'].split(",")
+            elif type(params['volumes_from']) is not list:
+                raise ContainerManagerException({'Invalid argument': params['volumes_from']})
+
+        for i in ('mem_limit', 'memswap_limit'):
+            if params.get(i) is not None:
+                params[i] = parse_bytes(params[i])
+
+        for i in ('cpu_shares', 'blkio_weight'):
+            if params.get(i) is not None:
+                try:
+                    params[i] = int(params[i])
+                except ValueError:
+                    raise ContainerManagerException({'Invalid argument': params[i]})
+
+        # The daemon reports the cpuset as a string such as "0-3", while
+        # containers items and spec files keep YAML ints
+        if params.get('cpuset') is not None:
+            params['cpuset'] = str(params['cpuset'])
+
+        if params.get('restart_policy') and type(params['restart_policy']) is not dict:
+            values = str(params['restart_policy']).split(":")
+            if len(values) > 2 or values[0] not in ("no", "always", "on-failure", "unless-stopped"):
+                raise ContainerManagerException({'Invalid argument': params['restart_policy']})
+            try:
+                retries = int(values[1]) if len(values) == 2 else 0
+            except ValueError:
+                raise ContainerManagerException({'Invalid argument': params['restart_policy']})
+            params['restart_policy'] = {'Name': values[0], 'MaximumRetryCount': retries}
+
         return params
 
+    def get_fingerprint(self):
+        """
+        Stable hash of the parts of the spec that are compared by ensure_same.
+        The fields that can be updated in place are left out, because an
+        update does not change the label.
+        """
+        params = self.params
+        spec = {
+            'image': params.get('image'),
+            'command': self.get_command(),
+            'environment': sorted(x for x in params.get('environment') or []
+                    if not x.startswith("ANSIBLE_MANAGED_ENVS=")),
+            'binds': self.get_bind_list(),
+            'port_bindings': sorted(self.get_port_binding_list()),
+            'links': sorted((params.get('links') or {}).items()),
+        }
+        if params.get('volumes_from'):
+            spec['volumes_from'] = sorted(params['volumes_from'])
+        return hashlib.sha256(json.dumps(spec, sort_keys = True).encode("utf-8")).hexdigest()
+
+    def get_command(self):
+        command = self.params.get('command')
+        if type(command) is str:
+            return shlex.split(command)
+        return command
+
+    def get_bind_list(self):
+        binds = self.params.get('binds') or {}
+        return sorted(
+            ":".join([x, binds[x]['bind'], "ro" if binds[x]['ro'] else "rw"]) for x in binds
+        )
+
+    def get_port_binding_list(self):
+        port_bindings = []
+        for key, val in (self.params.get('port_bindings') or {}).items():
+            if "/" not in key:
+                key = "{0}/tcp".format(key)
+            if type(val) is tuple:
+                port_bindings.append((key, val[0], val[1] if len(val) == 2 else ""))
+            else:
+                port_bindings.append((key, "", val or ""))
+        return port_bindings
+
+    def add_default_tag(self, image):
+        image_split = image.split("/")[-1].split(":")
+        if len(image_split) == 1:
+            return "{0}:latest".format(image)
+        return image
+
+    def dispatch(self):
+        state = self.params.get('state')
+        if state == "present":
+            self.ensure_present()
+        elif state == "running":
+            self.ensure_running()
+        elif state == "running_latest":
+            self.ensure_running_latest()
+        elif state == "stopped":
+            self.ensure_stopped()
+        elif state == "absent":
+            self.ensure_absent()
+        elif state == "restarted":
+            self.restart()
+        elif state == "logs":
+            self.read_logs()
+        elif state == "stats":
+            self.read_stats()
+        elif state == "image_present":
+            self.ensure_image_present()
+        elif state == "image_latest":
+            self.ensure_image_latest()
+        elif state == "image_absent":
+            self.ensure_image_absent()
+        elif state == "image_pruned":
+            self.ensure_image_pruned()
+        elif state == "image_loaded":
+            self.ensure_image_loaded()
+        elif state == "image_saved":
+            self.ensure_image_saved()
+
+    def ensure_containers(self):
+        specs = self.params['containers']
+        if type(specs) is not list:
+            raise ContainerManagerException({'Invalid argument': specs})
+
+        managers = {}
+        for spec in specs:
+            manager = self.create_child_manager(spec)
+            if manager.params['name'] in managers:
+                raise ContainerManagerException({'Duplicate container': manager.params['name']})
+            managers[manager.params['name']] = manager
+        waves = get_waves(dict((x, managers[x].get_dependencies()) for x in managers))
+
+        # One listing serves every container in the batch
+        self.inventory.load_containers()
+
+        # The waves are handled one after another so that the containers a
+        # container links to or takes volumes from exist before it is
+        # started. The containers of a wave are handled concurrently.
+        errors = {}
+        recreated = set()
+        for wave in waves:
+            ready = []
+            for name in wave:
+                failed = [x for x in managers[name].get_dependencies() if x in errors]
+                if failed:
+                    errors[name] = ContainerManagerException({'Dependency failed': failed})
+                else:
+                    ready.append(managers[name])
+            results = run_concurrently(
+                lambda x: x.reconcile(recreated),
+                ready, self.params['parallelism']
+            )
+            for manager, (_, error) in zip(ready, results):
+                if error:
+                    errors[manager.params['name']] = error
+                elif manager.recreated:
+                    recreated.add(manager.params['name'])
+
+        self.container_results = {}
+        for name in [x for wave in waves for x in wave]:
+            manager = managers[name]
+            error = errors.get(name)
+            result = {'changes_made': manager.changes_made}
+            if manager.time_to_ready is not None:
+                result['time_to_ready'] = manager.time_to_ready
+            if self.check_mode:
+                result['plan'] = manager.get_container_plan()
+                for image, image_result in manager.image_results.items():
+                    self.image_results.setdefault(image, image_result)
+            if error:
+                result['failed'] = True
+                result['msg'] = str(error)
+            self.container_results[manager.params['name']] = result
+            self.changes_made.extend({manager.params['name']: x} for x in manager.changes_made)
+
+    def create_child_manager(self, spec):
+        if type(spec) is not dict:
+            raise ContainerManagerException({'Invalid container spec': spec})
+        spec = check_options(spec, [x for x in ARGUMENT_SPEC if x not in RUN_OPTIONS])
+        if not spec.get('name'):
+            raise ContainerManagerException({'Invalid container spec': spec})
+        if spec.get('state') not in (None,) + CONTAINER_STATES:
+            raise ContainerManagerException({'Invalid state': spec.get('state')})
+
+        params = dict((k, v) for k, v in self.module.params.items() if k != 'containers')
+        params.update(spec)
+        params['state'] = spec.get('state') or self.module.params.get('state') or "running"
+        return ContainerManager(self.module, params, self.client, self.inventory)
+
+    def get_dependencies(self):
+        """
+        Return the names of the containers this container links to or takes
+        volumes from.
+        """
+        if self.params.get('state') in NAME_ONLY_STATES:
+            return []
+        names = list(self.params.get('links') or {})
+        names.extend(x.split(":")[0] for x in self.params.get('volumes_from') or [])
+        return sorted(set(x.lstrip("/") for x in names))
+
+    def reconcile(self, recreated):
+        """
+        Handle the container of a batch. A running container is restarted if
+        a container it depends on was recreated, so that it does not keep
+        using the removed one.
+        """
+        self.dispatch()
+        if not recreated.intersection(self.get_dependencies()):
+            return
+        if self.params['state'] not in ("running", "running_latest"):
+            return
+        actions = set(x for change in self.changes_made for x in change)
+        if actions & set(("CREATED", "STARTED", "RESTARTED")):
+            return
+        container = self.find_container(self.params['name'])
+        if container and container['State']['Running']:
+            self.restart_container(container)
+
     def ensure_present(self):
         required_params = ("name", "image")
         self.check_required_parameters(required_params)
 
+        if self.is_up_to_date(self.find_container_summary(self.params['name'])):
+            return
         container = self.find_container(self.params['name'])
         self.__ensure_present(container)
 
@@ -226,6 +1917,8 @@ class ContainerManager():
         required_params = ("name", "image")
         self.check_required_parameters(required_params)
 
+        if self.is_up_to_date(self.find_container_summary(self.params['name']), running = True):
+            return
         container = self.find_container(self.params['name'])
         container = self.__ensure_present(container)
         if not container['State']['Running']:
@@ -235,16 +1928,21 @@ class ContainerManager():
         required_params = ("name", "image")
         self.check_required_parameters(required_params)
 
+        if self.params.get('latest_image'):
+            image = self.__ensure_image_latest(self.params['image'])
+        else:
+            image = self.find_image(self.params['image'])
+        summary = self.find_container_summary(self.params['name'])
+        if image and self.is_up_to_date(summary, True, image):
+            return
         container = self.find_container(self.params['name'])
-        image = self.find_image(self.params['image'])
         if not container:
             container = self.__ensure_present(container)
         elif not self.is_running_latest_image(container, image):
-            self.remove_container(container)
-            container = self.__ensure_present()
+            self.drift = ["latest_image" if self.params.get('latest_image') else "image"]
+            container = self.recreate_container(container)
         elif not self.ensure_same(container):
-            self.ensure_absent()
-            container = self.__ensure_present()
+            container = self.recreate_container(container)
 
         if not container['State']['Running']:
             self.start_container(container)
@@ -264,7 +1962,8 @@ class ContainerManager():
         self.check_required_parameters(required_params)
 
         container = self.find_container(self.params['name'])
-        self.remove_container(container)
+        if container:
+            self.remove_container(container)
 
     def restart(self):
         required_params = ("name",)
@@ -277,42 +1976,414 @@ class ContainerManager():
             raise ContainerManagerException("Container not running")
         self.restart_container(container)
 
+    def read_logs(self):
+        required_params = ("name",)
+        self.check_required_parameters(required_params)
+
+        container = self.find_container(self.params['name'])
+        if not container:
+            raise ContainerManagerException("Container not found")
+
+        params = {'stdout': 1, 'stderr': 1, 'follow': 0, 'timestamps': 0, 'tail': "all"}
+        if self.params.get('tail') is not None:
+            params['tail'] = self.params['tail']
+        for i in ('since', 'until'):
+            if self.params.get(i) is not None:
+                params[i] = parse_time(self.params[i])
+        max_bytes = parse_bytes(self.params['max_bytes'])
+        grep = None
+        if self.params.get('grep'):
+            try:
+                grep = re.compile(self.params['grep'])
+            except re.error:
+                raise ContainerManagerException({'Invalid argument': self.params['grep']})
+
+        # The logs method of docker-py reads the whole log into memory and
+        # mixes stdout with stderr, so the stream is read directly and
+        # closed as soon as the bound is reached
+        url = self.client._url("/containers/{0}/logs", container['Id'])
+        start = time.time()
+        response = self.client._get(url, params = params, stream = True)
+        try:
+            self.client._raise_for_status(response)
+            self.log_results = read_logs(response.raw, container['Config'].get('Tty'), max_bytes, grep)
+        finally:
+            response.close()
+            self.record_response('logs', start, response)
+
+    def read_stats(self):
+        containers = self.find_stats_containers()
+        window = self.params.get('window')
+        if window is None or window <= 0:
+            raise ContainerManagerException({'Invalid argument': window})
+
+        # Every container is sampled at the same time so that the window is
+        # the same for all of them
+        deadline = time.time() + window
+        running = [x for x in containers if (x.get('State') or "running") == "running"]
+        results = run_concurrently(lambda x: self.sample_stats(x, deadline), running, len(running))
+
+        self.stats_results = {}
+        for summary in containers:
+            self.stats_results[summary['Names'][0].lstrip("/")] = {'running': False}
+        for summary, (result, error) in zip(running, results):
+            if error:
+                raise error
+            result['running'] = True
+            self.stats_results[summary['Names'][0].lstrip("/")] = result
+
+    def find_stats_containers(self):
+        names = self.params.get('name') or []
+        if type(names) is not list:
+            names = [names]
+        labels = self.params.get('label') or []
+        if type(labels) is not list:
+            labels = labels.split(",")
+        if not names and not labels:
+            raise ContainerManagerException("name or label required for stats state")
+
+        found = {}
+        for name in names:
+            summary = self.find_container_summary(name)
+            if not summary:
+                raise ContainerManagerException({'Container not found': name})
+            found[summary['Id']] = summary
+        if labels:
+            filters = {'label': labels, 'status': "running"}
+            for summary in self.inventory.query_containers(filters):
+                found[summary['Id']] = summary
+        return [found[x] for x in sorted(found)]
+
+    def sample_stats(self, summary, deadline):
+        # The stats method of docker-py does not give access to the response,
+        # so the stream is read directly to be able to close it at the end of
+        # the window
+        aggregate = StatsAggregate()
+        url = self.client._url("/containers/{0}/stats", summary['Id'])
+        start = time.time()
+        response = self.client._get(url, stream = True)
+        try:
+            self.client._raise_for_status(response)
+            for sample in decode_json_stream(self.client._stream_helper(response)):
+                aggregate.update(sample)
+                if time.time() >= deadline:
+                    break
+        finally:
+            response.close()
+            self.record_response('stats', start, response)
+        return aggregate.summary()
+
+    def record_response(self, name, start, response):
+        if isinstance(self.client, ProfilingClient):
+            self.client.record_response(name, start, response)
+
     def ensure_image_present(self):
         required_params = ("image",)
         self.check_required_parameters(required_params)
 
-        self.__ensure_image_present(self.params['image'])
+        images = self.get_image_list()
+        self.pull_images([x for x in images if not self.find_image(x)])
 
     def ensure_image_latest(self):
         required_params = ("image",)
         self.check_required_parameters(required_params)
 
-        self.__ensure_image_latest(self.params['image'])
+        self.pull_images(self.get_image_list(), latest = True)
 
     def ensure_image_absent(self):
         required_params = ("image",)
         self.check_required_parameters(required_params)
 
         name = self.params['image']
-        if self.find_image(name):
-            self.client.remove_image(name)
+        image = self.find_image(name)
+        if image:
+            if not self.check_mode:
+                self.client.remove_image(name)
+                self.inventory.remove_image(image['Id'])
+            self.write_log('REMOVED', image)
+
+    def ensure_image_pruned(self):
+        patterns = self.get_image_list() if self.params.get('image') else ["*"]
+        for pattern in patterns:
+            # Repository names have no quotes, commas or spaces, so such a
+            # pattern, for example a list turned into a string, would
+            # silently match nothing
+            if re.search(r"[\s,'\"]", pattern):
+                raise ContainerManagerException({'Invalid argument': pattern})
+        keep = self.params.get('keep')
+        if keep is None or keep < 0:
+            raise ContainerManagerException({'Invalid argument': keep})
+
+        # One listing of the images and one of all the containers is enough
+        # to decide what can be removed
+        images = self.inventory.get_images()
+        used = self.inventory.get_used_images()
+
+        members = {}
+        matched = {}
+        for image in images.values():
+            for repo in get_image_repositories(image):
+                names = (repo, normalize_image_name(repo).rsplit(":", 1)[0])
+                if any(fnmatch.fnmatchcase(x, p) for x in names for p in patterns):
+                    members.setdefault(repo, []).append(image)
+                    matched.setdefault(image['Id'], set()).add(repo)
+
+        # The newest images of every repository are kept. A tagged image wins
+        # over an untagged one that was created in the same second.
+        kept = set()
+        for repo in members:
+            newest = sorted(members[repo], reverse = True,
+                    key = lambda x: (x.get('Created') or 0, bool(x.get('RepoTags')) and x['RepoTags'] != ["<none>:<none>"]))
+            kept.update(x['Id'] for x in newest[:keep])
+
+        # Images that also belong to repositories outside of the patterns
+        # are left alone
+        removable = set(
+            x for x in matched
+            if x not in used and x not in kept and matched[x] == get_image_repositories(images[x])
+        )
+
+        # Parents of the remaining images cannot be removed either
+        pending = [x for x in images if x not in removable]
+        while pending:
+            parent = images[pending.pop()].get('ParentId')
+            if parent in removable:
+                removable.discard(parent)
+                pending.append(parent)
+
+        self.prune_results = {'removed': [], 'reclaimed_bytes': 0, 'skipped': {}}
+        while removable:
+            # Children are removed before their parents
+            parents = set(images[x].get('ParentId') for x in removable)
+            wave = sorted(x for x in removable if x not in parents)
+            removable.difference_update(wave)
+            results = run_concurrently(
+                lambda x: self.remove_image(images[x]),
+                wave, self.params.get('parallelism') or 1
+            )
+
+            errors = []
+            for image_id, (_, error) in zip(wave, results):
+                if error is None:
+                    image = images[image_id]
+                    self.prune_results['removed'].append(image_id)
+                    self.prune_results['reclaimed_bytes'] += image.get('Size', 0) - max(image.get('SharedSize', 0), 0)
+                    self.write_log('REMOVED', image)
+                elif self.is_conflict(error):
+                    # The image got a new container or child since listing
+                    self.prune_results['skipped'][image_id] = str(error)
+                else:
+                    errors.append(error)
+            if errors:
+                raise errors[0]
+
+    def ensure_image_loaded(self):
+        required_params = ("path",)
+        self.check_required_parameters(required_params)
+
+        path = self.params['path']
+        images = read_image_archive(path)
+        missing = [x for x, _ in images if not self.find_image(x)]
+        self.archive_results = {'path': path, 'images': [x for x, _ in images], 'loaded': bool(missing)}
+        if missing and self.check_mode:
+            for image_id in missing:
+                self.write_log('LOADED', {'Id': image_id})
+            images = [x for x in images if x[0] not in missing]
+        elif missing:
+            # The archive is streamed from the file so that it is never read
+            # into memory whole. A checksum recorded by image_saved is
+            # verified on the way.
+            reader = ChecksumReader(path, read_checksum(path))
+            try:
+                self.client.load_image(reader)
+            finally:
+                reader.close()
+            self.inventory.reload_images()
+
+        tagged = False
+        for image_id, tags in images:
+            image = self.find_image(image_id)
+            if not image:
+                raise ContainerManagerException({'Load failed': "{0} not found after loading {1}".format(image_id, path)})
+            if image_id in missing:
+                self.write_log('LOADED', image)
+                continue
+            # The image was already there, but the tags may point elsewhere
+            for tag in tags:
+                if (self.find_image(tag) or {}).get('Id') != image_id:
+                    repo, tag = tag.rsplit(":", 1)
+                    if not self.check_mode:
+                        self.client.tag(image_id, repo, tag = tag, force = True)
+                        tagged = True
+                    self.write_log('TAGGED', {'Id': image_id, 'Image': "{0}:{1}".format(repo, tag)})
+        if tagged:
+            self.inventory.reload_images()
+
+    def ensure_image_saved(self):
+        required_params = ("image", "path")
+        self.check_required_parameters(required_params)
+
+        name = self.params['image']
+        path = self.params['path']
+        image = self.find_image(name)
+        if not image:
+            raise ContainerManagerException({'Image not found': name})
+        self.archive_results = {'path': path, 'images': [image['Id']], 'saved': False}
+
+        # An archive of the same image that still matches the checksum
+        # recorded when it was saved is not saved again
+        checksum = read_checksum(path)
+        if checksum and os.path.exists(path):
+            try:
+                ids = [x for x, _ in read_image_archive(path)]
+            except ContainerManagerException:
+                ids = []
+            if ids == [image['Id']] and get_file_checksum(path) == checksum:
+                self.archive_results['sha256'] = checksum
+                return
+        if self.check_mode:
+            self.archive_results['saved'] = True
+            self.write_log('SAVED', image)
+            return
+
+        # The image is streamed to a temporary file next to the archive so
+        # that a failed save does not leave a partial archive behind
+        import tempfile
+        fd, temp_path = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(path)), prefix = ".dockerimp-")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                stream = self.client.get_image(name)
+                for chunk in iter(lambda: stream.read(ARCHIVE_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            os.rename(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        write_checksum(path, digest.hexdigest())
+        self.archive_results.update({'saved': True, 'sha256': digest.hexdigest(), 'bytes': size})
+        self.write_log('SAVED', image)
+
+    def get_image_list(self):
+        images = self.params['image']
+        if type(images) is not list:
+            images = [images]
+        return images
 
     def __ensure_present(self, container = None):
         if not container:
             self.__ensure_image_present(self.params['image'])
             container = self.create_container()
         elif not self.ensure_same(container):
-            self.ensure_absent()
-            container = self.__ensure_present()
+            container = self.recreate_container(container)
         return container
 
+    def recreate_container(self, container):
+        # Containers binding fixed host ports cannot run side by side, so they
+        # are always stopped before the replacement is started
+        start_first = self.params.get('replace_strategy') == "start_first"
+        self.recreated = True
+        if start_first and container['State']['Running'] and not self.has_fixed_host_ports() and not self.check_mode:
+            return self.replace_container(container)
+        self.remove_container(container)
+        return self.__ensure_present()
+
+    def replace_container(self, container):
+        # Start the replacement under a temporary name and remove the old
+        # container only after the new one is up
+        name = self.params['name']
+        temp_name = "{0}_dockerimp_{1}".format(name, int(time.time() * 1000))
+        self.__ensure_image_present(self.params['image'])
+        new = self.create_container(temp_name)
+        try:
+            since = time.time()
+            new = self.start_container(new)
+            has_health = (new['State'].get('Health') or new['Config'].get('Healthcheck'))
+            condition = "healthy" if has_health else "running"
+            new = self.wait_until_ready(new, condition, self.params['replace_timeout'], since)
+        except Exception:
+            self.remove_container(self.get_info(new))
+            raise
+
+        self.remove_container(container)
+        self.client.rename(new, name)
+        new = self.get_info(new)
+        self.write_log('RENAMED', new)
+        return new
+
+    def wait_until_ready(self, container, condition, timeout, since, restarted = None):
+        """
+        Wait until the container is running or healthy. The docker events of
+        the container are followed from the time it was started, so the
+        container does not have to be polled. For a restart, the die and
+        health events from before the restart completed belong to the
+        stopped container and are skipped.
+        """
+        deadline = time.time() + timeout
+        if self.is_ready(container, condition):
+            return container
+
+        filters = {'container': container['Id'], 'event': ["start", "die", "health_status"]}
+        stream = self.client.events(since = int(since), until = int(deadline) + 1, filters = filters)
+        for event in decode_json_stream(stream):
+            # The since filter has a resolution of a second, so skip events
+            # from before the start
+            if event.get('timeNano') and event['timeNano'] < since * 1e9:
+                continue
+            status = event.get('status') or event.get('Action') or ""
+            if restarted and status != "start" and event.get('timeNano') and event['timeNano'] < restarted * 1e9:
+                continue
+            if status == "die":
+                raise ContainerManagerException({'Container exited': container['Id']})
+            if status == "health_status: unhealthy":
+                raise ContainerManagerException({'Container unhealthy': container['Id']})
+            if (status == "start" and condition == "running") or status == "health_status: healthy":
+                return self.get_info(container)
+            if time.time() > deadline:
+                break
+
+        # The stream may have ended before the events were seen
+        container = self.get_info(container)
+        if self.is_ready(container, condition):
+            return container
+        raise ContainerManagerException({'Timeout waiting for container': container['Id']})
+
+    def is_ready(self, container, condition):
+        state = container['State']
+        health = (state.get('Health') or {}).get('Status')
+        if not state['Running'] and not state.get('Restarting'):
+            raise ContainerManagerException({'Container exited': container['Id']})
+        if health == "unhealthy":
+            raise ContainerManagerException({'Container unhealthy': container['Id']})
+        if condition == "healthy" and not health:
+            raise ContainerManagerException({'Container has no health check': container['Id']})
+        if condition == "healthy":
+            return health == "healthy"
+        return state['Running']
+
+    def has_fixed_host_ports(self):
+        for binding in (self.params.get('port_bindings') or {}).values():
+            if type(binding) is tuple and len(binding) == 2:
+                return True
+            if type(binding) is not tuple and binding:
+                return True
+        return False
+
     def __ensure_image_present(self, name):
         image = self.find_image(name)
         if not image:
             self.pull_image(name)
 
     def __ensure_image_latest(self, name):
-        self.pull_image(name)
+        if normalize_image_name(name) not in self.image_results:
+            self.pull_images([name], latest = True)
+        if self.image_results[normalize_image_name(name)].get('pull'):
+            # In check mode the image that the pull would bring is not known
+            return {'Id': None}
         return self.find_image(name)
 
     def check_required_parameters(self, required):
@@ -323,35 +2394,25 @@ class ContainerManager():
                 raise ContainerManagerException(error_msg)
 
     def find_container(self, name):
-        containers = self.client.containers(all = True)
-        c = [x for x in containers if
-                ((x['Names'] or [""])[0] == "/{0}".format(name)) or
-                (len(name) > 9 and x['Id'].startswith(name))]
+        summary = self.find_container_summary(name)
+        if summary:
+            container = self.inventory.get_container_details(summary['Id'])
+            return container or self.get_info(summary['Id'])
+        return None
+
+    def find_container_summary(self, name):
+        c = self.inventory.find_containers(name)
         if len(c) > 1:
             error_msg = "Found more than one container with name or id"
             raise ContainerManagerException({'Unexpected error': error_msg})
         if c:
-            container = self.get_info(c[0])
-            return container
+            return self.inventory.get_container_summary(c[0])
         return None
 
     def find_image(self, name):
-        # client.images method does not throw an error if image is not found, it just
-        # returns an empty array. client.inspect_image throws an error if image is not
-        # found. Propably cleaner to do this way than to catch an error.
-        image_name = name.split(":")
-
-        # image name may contain port, so rejoin everything exept last item which is tag
-        images = self.client.images(name = ":".join(image_name[:-1]))
-        image_len = len(images)
-        if image_len == 0:
-            return None
-        else:
-            for i in images:
-                if name in i['RepoTags']:
-                    return self.client.inspect_image(name)
-            else:
-                return None
+        # Images are looked up from the inventory snapshot. The image listing
+        # has the image id so inspecting the image is not needed.
+        return self.inventory.find_image(name)
 
     def is_running_latest_image(self, container, image):
         if not image:
@@ -362,36 +2423,128 @@ class ContainerManager():
             return False
 
     def get_info(self, container):
-        return self.client.inspect_container(container)
+        info = self.client.inspect_container(container)
+        self.inventory.update_container(info)
+        return info
 
     def get_image_info(self, image):
         return self.client.inspect_image(image)
 
     def pull_image(self, name):
-        insecure_registry = self.params['insecure_registry']
-        old = self.find_image(name)
-        self.client.pull(name, insecure_registry = insecure_registry)
-        new = self.find_image(name)
-        if not new:
-            error_msg = "Cannot find {0}".format(name)
-            raise ContainerManagerException({'Image not found': error_msg})
-        elif new['Id'] != (old or {}).get('Id'):
-            self.write_log('PULLED', new)
-
-    def create_container(self):
+        self.pull_images([name])
+
+    def pull_images(self, names, latest = False):
+        if not names:
+            return
+
+        # Collapse references that point to the same image so that each one
+        # is pulled only once
+        pulls = {}
+        for name in names:
+            pulls.setdefault(normalize_image_name(name), name)
+
+        old = dict((x, (self.find_image(x) or {}).get('Id')) for x in names)
+        results = run_concurrently(
+            lambda x: self.__pull(x, latest),
+            sorted(pulls.values()), self.params.get('parallelism') or 1
+        )
+        for _, error in results:
+            if error:
+                raise error
+
+        if any(x for x, _ in results) and not self.check_mode:
+            self.inventory.reload_images()
+        for name in names:
+            if self.image_results[normalize_image_name(name)].get('pull'):
+                self.write_log('PULLED', {'Image': name})
+                continue
+            new = self.find_image(name)
+            if not new:
+                error_msg = "Cannot find {0}".format(name)
+                raise ContainerManagerException({'Image not found': error_msg})
+            elif new['Id'] != old[name]:
+                self.write_log('PULLED', new)
+
+            result = self.image_results.setdefault(normalize_image_name(name), {})
+            result['digest'] = get_local_digest(new, name) or result.get('digest')
+
+    def __pull(self, name, latest):
+        # Returns True if the image was pulled
+        result = self.image_results.setdefault(normalize_image_name(name), {'pulled': False})
+        if latest:
+            local = get_local_digest(self.find_image(name), name)
+            if local:
+                remote = get_registry_digest(name, self.params['insecure_registry'])
+                result['digest'] = remote
+                if remote == local:
+                    return False
+
+        if self.check_mode:
+            architecture = self.inventory.get_version().get('Arch') or "amd64"
+            result['pull'] = True
+            result['download_bytes'] = get_registry_download_size(name, architecture, self.params['insecure_registry'])
+            return True
+
+        # The progress is consumed as it arrives so that the output of big
+        # images is not buffered and errors are noticed right away
+        start = time.time()
+        progress = PullProgress()
+        stream = self.client.pull(name, stream = True, insecure_registry = self.params['insecure_registry'])
+        for event in decode_json_stream(stream):
+            progress.update(event)
+        result['pulled'] = True
+        result['duration'] = round(time.time() - start, 3)
+        result['layers'] = progress.summary()
+        return True
+
+    def create_container(self, name = None):
         params = self.params
 
         key_filter = (
             'image', 'command', 'hostname', 'user',
-            'detach', 'stdin_open', 'tty', 'mem_limit',
+            'detach', 'stdin_open', 'tty',
             'ports', 'environment', 'dns', 'volumes',
-            'volumes_from', 'network_disabled', 'name',
-            'entrypoint', 'cpu_shares', 'working_dir',
-            'memswap_limit'
+            'network_disabled', 'name',
+            'entrypoint', 'working_dir', 'stop_signal'
         )
         filtered = { x: params[x] for x in key_filter if x in params }
+        filtered['labels'] = {FINGERPRINT_LABEL: self.get_fingerprint()}
+
+        # Since API 1.19 the resource limits are part of the host config and
+        # docker-py refuses them in the container config
+        resources = dict(
+            (LIVE_UPDATE_FIELDS[x], params[x]) for x in RESOURCE_FIELDS if params.get(x) is not None
+        )
+        update_blkio = False
+        if resources and import_docker().utils.version_gte(self.client.api_version, "1.19"):
+            host_config = self.client.create_host_config(**resources)
+            # Some docker-py versions misspell the key, which only daemons
+            # that match keys case-insensitively accept
+            if 'CpuSetCpus' in host_config:
+                host_config['CpusetCpus'] = host_config.pop('CpuSetCpus')
+            filtered['host_config'] = host_config
+        else:
+            for option in ('mem_limit', 'memswap_limit', 'cpu_shares', 'cpuset'):
+                filtered[option] = params.get(option)
+            # The container config has no field for the blkio weight
+            update_blkio = params.get('blkio_weight') is not None
+        if name:
+            filtered['name'] = name
+
+        if self.check_mode:
+            container = {
+                'Id': None,
+                'Name': "/{0}".format(filtered['name']),
+                'Image': (self.find_image(params['image']) or {}).get('Id'),
+                'Config': {'Image': params['image']},
+                'State': {'Running': False},
+            }
+            self.write_log('CREATED', container)
+            return container
 
         c = self.client.create_container(**filtered)
+        if update_blkio:
+            self.client.update_container(c, blkio_weight = params['blkio_weight'])
         container = self.get_info(c)
         self.write_log('CREATED', container)
         return container
@@ -406,46 +2559,161 @@ class ContainerManager():
         )
         filtered = { x: params[x] for x in key_filter if x in params }
 
+        if self.check_mode:
+            container = dict(container, State = dict(container['State'], Running = True))
+            self.write_log('STARTED', container)
+            return container
+
+        started = time.time()
         self.client.start(container, **filtered)
         container = self.get_info(container)
         self.write_log('STARTED', container)
+        return self.wait_after_start(container, started)
+
+    def wait_after_start(self, container, started, restarted = None):
+        if self.params.get('wait'):
+            # Events are followed from before the start so that none is lost
+            # between the start and the events request
+            container = self.wait_until_ready(container, self.params['wait'], self.params['wait_timeout'], started, restarted)
+            self.time_to_ready = round(time.time() - started, 3)
         return container
 
     def stop_container(self, container):
-        self.client.stop(container)
+        if self.check_mode:
+            container = dict(container, State = dict(container['State'], Running = False))
+            self.write_log('STOPPED', container)
+            return container
+        self.__stop(container)
         container = self.get_info(container)
         self.write_log('STOPPED', container)
         return container
 
+    def __stop(self, container):
+        stop_timeout = self.params.get('stop_timeout')
+        if stop_timeout is None:
+            stop_timeout = 10
+        if not self.params.get('stop_signal') or not stop_timeout:
+            # Without time to exit the container is killed right away
+            self.client.stop(container, timeout = stop_timeout)
+            return
+
+        # Send the requested signal and kill the container if it has not
+        # exited in stop_timeout seconds
+        import requests
+        self.client.kill(container, signal = self.params['stop_signal'])
+        try:
+            self.client.wait(container, timeout = stop_timeout)
+        except requests.exceptions.RequestException:
+            self.client.stop(container, timeout = 0)
+
     def remove_container(self, container):
-        if container['State']['Running']:
-            container = self.stop_container(container)
-        self.client.remove_container(container)
-        c = self.find_container(container['Id'])
-        if c:
+        remove_volumes = bool(self.params.get('remove_volumes'))
+        if self.check_mode:
+            if container['State']['Running'] and not self.params.get('force_remove'):
+                self.write_log('STOPPED', container)
+            self.write_log('REMOVED', container)
+            return
+        if self.params.get('force_remove'):
+            self.client.remove_container(container, v = remove_volumes, force = True)
+        else:
+            if container['State']['Running']:
+                # The stopped state is not needed for removing, so the
+                # container is not inspected again
+                self.__stop(container)
+                self.write_log('STOPPED', container)
+            self.client.remove_container(container, v = remove_volumes)
+        if self.container_exists(container['Id']):
             raise ContainerManagerException("Could not remove the container")
+        self.inventory.remove_container(container['Id'])
         self.write_log('REMOVED', container)
 
+    def remove_image(self, image):
+        # An image that is tagged in many repositories can be removed by id
+        # only with force
+        force = len(image.get('RepoTags') or []) > 1
+        if self.check_mode:
+            return
+        self.client.remove_image(image['Id'], force = force)
+        self.inventory.remove_image(image['Id'])
+
+    def is_conflict(self, error):
+        return isinstance(error, import_docker().errors.APIError) and \
+            error.response is not None and error.response.status_code == 409
+
+    def container_exists(self, container_id):
+        try:
+            self.client.inspect_container(container_id)
+            return True
+        except import_docker().errors.APIError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return False
+            raise
+
+    def update_container(self, container, fields):
+        params = self.params
+        filtered = dict((LIVE_UPDATE_FIELDS[x], params[x]) for x in fields)
+        if self.check_mode:
+            self.write_log('UPDATED', container)
+            return container
+        self.client.update_container(container, **filtered)
+        container = self.get_info(container)
+        self.write_log('UPDATED', container)
+        return container
+
     def restart_container(self, container):
-        self.client.restart(container)
+        if self.check_mode:
+            self.write_log('RESTARTED', container)
+            return container
+        started = time.time()
+        stop_timeout = self.params.get('stop_timeout')
+        self.client.restart(container, timeout = 10 if stop_timeout is None else stop_timeout)
+        restarted = time.time()
         container = self.get_info(container)
         self.write_log('RESTARTED', container)
+        return self.wait_after_start(container, started, restarted)
 
     def ensure_same(self, container):
+        drift = self.get_drift(container)
+        self.drift = drift
+
+        # Resource limits and restart policy can be changed without
+        # recreating the container
+        if drift and set(drift) <= set(LIVE_UPDATE_FIELDS) and self.can_update(drift):
+            self.update_container(container, drift)
+            return True
+        return not drift
+
+    def can_update(self, fields):
+        """
+        Tell whether the client can update the fields in place. This is
+        decided before the update so that check mode plans the same action
+        as a real run.
+        """
+        utils = import_docker().utils
+        if not utils.version_gte(self.client.api_version, "1.22"):
+            return False
+        if 'restart_policy' in fields and not utils.version_gte(self.client.api_version, "1.23"):
+            return False
+        arguments = get_update_arguments(self.client)
+        return all(LIVE_UPDATE_FIELDS[x] in arguments for x in fields)
+
+    def get_drift(self, container):
+        """
+        Return the names of the options whose values differ from the
+        container.
+        """
         params = self.params
-        require_restart = False
+        drift = []
 
         # Ensure running the right image
         if container['Config']['Image'] != params['image']:
-            require_restart = True
+            drift.append("image")
 
         # Ensure running latest image if the parameter is provided
-        same = True
         if params.get('latest_image'):
-            self.client.pull(params['image'])
-            if not self.running_latest_image(container, params['image']):
-                same = False
-                require_restart = True
+            image = self.__ensure_image_latest(params['image'])
+            if not self.is_running_latest_image(container, image):
+                drift.append("latest_image")
 
         # Ensure environment vars are up to date
         for i in container['Config']['Env']:
@@ -467,38 +2735,100 @@ class ContainerManager():
 
                 # Check same variables are set
                 if set(ansible_managed_envs) != set([x.split("=")[0] for x in env_params]):
-                    require_restart = True
+                    drift.append("env")
 
                 # Check that the values are right
                 else:
                     for env in env_params:
                         if env not in container['Config']['Env']:
-                            require_restart = True
+                            drift.append("env")
                             break
             else:
-                require_restart = True
+                drift.append("env")
 
         # Ensure volume mountings are right
         container_binds = container['HostConfig']['Binds']
         bind_params = params.get('binds')
         if container_binds or bind_params:
             if container_binds and bind_params:
-                _bind_params = [
-                    ":".join([
-                        x, bind_params[x]['bind'], "ro" if bind_params[x]['ro'] else "rw"
-                    ]) for x in bind_params
-                ]
-                if set(_bind_params) != set(container_binds):
-                    require_restart = True
+                if set(self.get_bind_list()) != set(container_binds):
+                    drift.append("volumes")
             else:
-                require_restart = True
+                drift.append("volumes")
 
         # Ensure command is right
         if params.get('command'):
-            if params['command'] != container['Command']:
-                require_restart = True
-
-        return require_restart != True
+            if self.get_command() != container['Config']['Cmd']:
+                drift.append("command")
+
+        # Ensure port bindings are right
+        container_ports = set()
+        for key, bindings in (container['HostConfig'].get('PortBindings') or {}).items():
+            for i in bindings or [{}]:
+                container_ports.add((key, i.get('HostIp') or "", i.get('HostPort') or ""))
+        if container_ports != set(self.get_port_binding_list()):
+            drift.append("ports")
+
+        # Ensure links are right. Links are listed in form
+        # /target:/container/alias
+        container_links = set()
+        for i in container['HostConfig'].get('Links') or []:
+            target, alias = i.split(":")
+            container_links.add((target.lstrip("/"), alias.split("/")[-1]))
+        if container_links != set((params.get('links') or {}).items()):
+            drift.append("links")
+
+        # Ensure the containers the volumes are taken from are right
+        if set(container['HostConfig'].get('VolumesFrom') or []) != set(params.get('volumes_from') or []):
+            drift.append("volumes_from")
+
+        # Ensure resource limits and restart policy are right
+        host_config = container['HostConfig']
+        config = container['Config']
+        resources = (
+            ('mem_limit', 'Memory'), ('memswap_limit', 'MemorySwap'),
+            ('cpu_shares', 'CpuShares'), ('cpuset', 'CpusetCpus'),
+            ('blkio_weight', 'BlkioWeight'),
+        )
+        for option, key in resources:
+            if params.get(option) is None:
+                continue
+            value = host_config.get(key)
+            if value is None:
+                # Older API versions report the limits in Config
+                value = config.get(key if key != 'CpusetCpus' else 'Cpuset')
+            if value != params[option]:
+                drift.append(option)
+
+        if params.get('restart_policy'):
+            policy = host_config.get('RestartPolicy') or {}
+            if (policy.get('Name') or "no") != params['restart_policy']['Name'] or \
+                    (policy.get('MaximumRetryCount') or 0) != params['restart_policy']['MaximumRetryCount']:
+                drift.append("restart_policy")
+
+        return drift
+
+    def is_up_to_date(self, summary, running = False, image = None):
+        """
+        Tell from the container listing alone if the container was created
+        from the requested spec, so that it does not need to be inspected.
+        """
+        if not summary:
+            return False
+        # The label does not tell the current values of the fields that can
+        # be updated in place, so they are compared from the inspect result
+        if any(self.params.get(x) is not None for x in LIVE_UPDATE_FIELDS):
+            return False
+        if (summary.get('Labels') or {}).get(FINGERPRINT_LABEL) != self.get_fingerprint():
+            return False
+        if running and summary.get('State') != "running" and \
+                not (summary.get('Status') or "").startswith("Up"):
+            return False
+        if self.params.get('latest_image') and not image:
+            image = self.__ensure_image_latest(self.params['image'])
+        if image and summary.get('ImageID') != image['Id']:
+            return False
+        return True
 
     def generate_message(self):
         if not self.has_changes():
@@ -519,58 +2849,904 @@ class ContainerManager():
             return True
         return False
 
-def main():
-    arguments = {
-        'state': {
-            'required': True,
-            'choices': [
-                "present", "running", "running_latest",
-                "stopped", "absent", "restarted",
-                "image_present", "image_latest",
-            ]
-        },
-        'name':                 { 'default': None, 'aliases': ["id"] },
-        'image':                { 'default': None },
-        'env':                  { 'default': None },
-        'volumes':              { 'default': None },
-        'ports':                { 'default': None },
-        'command':              { 'default': None },
-        'expose':               { 'default': None },
-        'links':                { 'default': None },
-        'insecure_registry':    { 'default': False, 'choises': BOOLEANS },
-    }
-    #module = AnsibleModule(argument_spec = arguments, supports_check_mode = True)
-    module = AnsibleModule(argument_spec = arguments)
+    def get_result(self):
+        result = {'changed': self.has_changes(), 'msg': self.generate_message()}
+        if self.container_results is not None:
+            result['changes_made'] = self.container_results
+            failed = sorted(x for x in self.container_results if self.container_results[x].get('failed'))
+            if failed:
+                result['failed'] = True
+                result['msg'] = "Failed to reconcile containers: {0}".format(", ".join(failed))
+        if self.image_results:
+            result['images'] = self.image_results
+        if self.prune_results is not None:
+            result['pruned'] = self.prune_results
+        if self.archive_results is not None:
+            result['archive'] = self.archive_results
+        if self.log_results is not None:
+            result['logs'] = self.log_results
+        if self.stats_results is not None:
+            result['stats'] = self.stats_results
+        if self.time_to_ready is not None:
+            result['time_to_ready'] = self.time_to_ready
+        if isinstance(self.client, ProfilingClient):
+            result['profile'] = self.client.summary()
+        if self.check_mode:
+            result['plan'] = self.get_plan()
+        return result
+
+    def get_plan(self):
+        """
+        Return what the run would do in check mode: the action and the
+        drifted options of every container and the images to pull with
+        their download sizes.
+        """
+        plan = {}
+        if self.container_results is not None:
+            plan['containers'] = dict((x, y['plan']) for x, y in self.container_results.items() if 'plan' in y)
+        elif self.params.get('state') in CONTAINER_STATES:
+            plan['containers'] = {self.params['name']: self.get_container_plan()}
+        plan['pull'] = self.get_pull_plan()
+        plan['download_bytes'] = sum(x for x in plan['pull'].values() if x)
+        return plan
+
+    def get_container_plan(self):
+        actions = set(x for change in self.changes_made for x in change)
+        if self.recreated:
+            action = "recreate"
+        else:
+            action = next((y for x, y in PLAN_ACTIONS if x in actions), "none")
+        plan = {'action': action, 'drift': self.drift}
+        pulls = self.get_pull_plan()
+        if pulls:
+            plan['pull'] = pulls
+        return plan
+
+    def get_pull_plan(self):
+        # Image names with the estimated download size, None if unknown
+        return dict((x, y.get('download_bytes')) for x, y in self.image_results.items() if y.get('pull'))
+
+CONTAINER_STATES = (
+    "present", "running", "running_latest",
+    "stopped", "absent", "restarted",
+)
+
+# Plan action of a container by the most significant change that the run
+# would make, when the container is not recreated
+PLAN_ACTIONS = (
+    ('CREATED', "create"), ('REMOVED', "remove"), ('UPDATED', "update"),
+    ('STARTED', "start"), ('RESTARTED', "restart"), ('STOPPED', "stop"),
+    ('PULLED', "pull"),
+)
+
+# States that use only the name of the container or the image
+NAME_ONLY_STATES = ("stopped", "absent", "restarted", "logs", "stats")
+IMAGE_STATES = (
+    "image_present", "image_latest", "image_absent", "image_pruned",
+    "image_loaded", "image_saved",
+)
+
+# Options that are declared raw so that AnsibleModule passes lists through,
+# and the states that accept a list for them
+LIST_OPTIONS = {
+    'name': ("stats",),
+    'image': ("image_present", "image_latest", "image_pruned"),
+    'label': ("stats",),
+}
+
+def run_manager(module, client = None, inventory = None):
+    """
+    Run the module and return the result that is passed to exit_json or
+    fail_json.
+    """
+    docker = import_docker()
+    import requests
+    if isinstance(client, ResilientClient):
+        # The circuit breaker of a client shared between runs starts closed
+        client.reset()
     try:
 
-        manager = ContainerManager(module)
-        state = module.params.get('state')
-        if state == "present":
-            manager.ensure_present()
-        elif state == "running":
-            manager.ensure_running()
-        elif state == "running_latest":
-            manager.ensure_running_latest()
-        elif state == "stopped":
-            manager.ensure_stopped()
-        elif state == "absent":
-            manager.ensure_absent()
-        elif state == "restarted":
-            manager.restart()
-        elif state == "image_present":
-            manager.ensure_image_present()
-        elif state == "image_latest":
-            manager.ensure_image_latest()
-        elif state == "image_absent":
-            manager.ensure_image_absent()
-        module.exit_json(changed = manager.has_changes(), msg = manager.generate_message())
+        manager = ContainerManager(module, client = client, inventory = inventory)
+        run = manager.ensure_containers if module.params.get('containers') else manager.dispatch
+        if module.params.get('profile_dump'):
+            import cProfile
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(run)
+            finally:
+                profiler.dump_stats(module.params['profile_dump'])
+        else:
+            run()
+        return manager.get_result()
 
     except ContainerManagerException as e:
-        module.fail_json(msg = str(e))
+        return {'failed': True, 'msg': str(e)}
     except docker.errors.APIError as e:
-        module.fail_json(msg = str(e))
+        return {'failed': True, 'msg': str(e)}
     except docker.errors.DockerException as e:
-        module.fail_json(msg = str(e))
+        return {'failed': True, 'msg': str(e)}
+    except requests.exceptions.RequestException as e:
+        return {'failed': True, 'msg': str(e)}
+
+HOST_OPTIONS = (
+    'client_url', 'tls', 'tls_verify', 'tls_ca_cert', 'tls_client_cert',
+    'tls_client_key', 'tls_hostname',
+)
+
+def run_hosts(module):
+    """
+    Run the module against every docker host of the hosts option, at most
+    host_parallelism at a time, and return the results per host. Hosts that
+    have not been started yet are skipped once more than max_failed_hosts
+    hosts have failed.
+    """
+    hosts = []
+    for host in module.params['hosts']:
+        if not isinstance(host, dict):
+            host = {'client_url': host}
+        try:
+            host = check_options(host, HOST_OPTIONS)
+        except ContainerManagerException as e:
+            return {'failed': True, 'msg': str({'Invalid host': "{0}: {1}".format(host, e)})}
+        if not host.get('client_url'):
+            return {'failed': True, 'msg': str({'Invalid host': host})}
+        hosts.append(host)
+    urls = [x['client_url'] for x in hosts]
+    if len(set(urls)) != len(urls):
+        return {'failed': True, 'msg': str({'Duplicate hosts': sorted(set(x for x in urls if urls.count(x) > 1))})}
+
+    docker = import_docker()
+    max_failed = module.params.get('max_failed_hosts') or 0
+    lock = threading.Lock()
+    failed = []
+
+    def run_host(host):
+        with lock:
+            if len(failed) > max_failed:
+                return {'skipped': True, 'msg': "Skipped after too many hosts failed"}
+        params = dict((k, v) for k, v in module.params.items() if k not in ('hosts', 'profile_dump'))
+        params.update(host)
+        try:
+            # Every call to the host during the run goes through the
+            # connection pool of this one client
+            client = create_client(params)
+        except docker.errors.DockerException as e:
+            result = {'failed': True, 'msg': str(e)}
+        else:
+            result = run_manager(HelperModule(params, module.check_mode), client)
+        if result.get('failed'):
+            with lock:
+                failed.append(host['client_url'])
+        return result
+
+    results = run_concurrently(run_host, hosts, module.params.get('host_parallelism') or 1)
+    host_results = {}
+    for url, (result, error) in zip(urls, results):
+        if error:
+            result = {'failed': True, 'msg': str(error)}
+            failed.append(url)
+        host_results[url] = result
+
+    result = {
+        'changed': any(x.get('changed') for x in host_results.values()),
+        'hosts': host_results,
+        'failed_hosts': sorted(failed),
+    }
+    if len(failed) > max_failed:
+        result['failed'] = True
+        result['msg'] = "{0} hosts failed, more than max_failed_hosts {1}: {2}".format(
+            len(failed), max_failed, ", ".join(sorted(failed)))
+    else:
+        changed = sorted(x for x in host_results if host_results[x].get('changed'))
+        result['msg'] = "Changed {0} of {1} hosts, {2} failed".format(len(changed), len(hosts), len(failed))
+    return result
+
+class HelperModule():
+    """
+    Stand-in for AnsibleModule for running the manager outside of ansible.
+    """
+
+    def __init__(self, params, check_mode = False):
+        self.params = params
+        self.check_mode = check_mode
+
+class Helper():
+    """
+    Long-lived process that runs module requests sent over a unix socket.
+
+    The helper keeps one docker client and one inventory between requests.
+    The inventory is invalidated from the docker events stream so that
+    changes made outside of the module are seen. The helper exits when no
+    request has arrived in idle_timeout seconds.
+    """
+
+    def __init__(self, path, params):
+        self.path = path
+        self.idle_timeout = params['helper_idle_timeout']
+        self.docker_client = create_client(params)
+        self.client = ResilientClient(self.docker_client, params.get('retries') or 0, params.get('breaker_threshold'))
+        self.inventory = Inventory(self.client)
+
+    def serve(self):
+        import fcntl
+        import socket
+
+        # Only one helper may serve a socket. The lock is held for the
+        # lifetime of the process so a stale socket can be safely removed.
+        # The lock file is not opened through a symlink planted by someone
+        # else.
+        lock = os.open("{0}.lock".format(self.path), os.O_WRONLY | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(lock)
+            return
+        if os.path.lexists(self.path):
+            os.unlink(self.path)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(umask)
+        server.listen(16)
+        server.settimeout(self.idle_timeout)
+
+        events = threading.Thread(target = self.watch_events)
+        events.daemon = True
+        events.start()
+
+        try:
+            while True:
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    break
+                try:
+                    self.handle(conn)
+                except socket.error:
+                    # The client went away, the helper keeps serving
+                    pass
+                finally:
+                    conn.close()
+        finally:
+            os.unlink(self.path)
+            server.close()
+            os.close(lock)
+
+    def handle(self, conn):
+        conn.settimeout(None)
+        try:
+            request = json.loads(read_message(conn))
+            module = HelperModule(request['params'], request.get('check_mode', False))
+            result = run_manager(module, self.client, self.inventory)
+        except Exception as e:
+            result = {'failed': True, 'msg': "Helper failed: {0}".format(e)}
+        conn.sendall((json.dumps(result) + "\n").encode("utf-8"))
+
+    def watch_events(self):
+        while True:
+            try:
+                stream = self.docker_client.events()
+                # Events may have been missed while the stream was down, so
+                # what was cached until the new stream was open is dropped
+                self.inventory.invalidate()
+                for event in decode_json_stream(stream):
+                    self.inventory.invalidate(event)
+            except Exception:
+                pass
+            time.sleep(1)
+
+def read_message(conn):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data.decode("utf-8")
+
+def get_helper_socket(params):
+    """
+    Return the path of the helper socket. The default socket is in a
+    directory of the temp directory that only the user can access.
+    """
+    import errno
+    import stat
+    import tempfile
+
+    if params.get('helper_socket'):
+        return params['helper_socket']
+    directory = os.path.join(tempfile.gettempdir(), "dockerimp-{0}".format(os.getuid()))
+    try:
+        os.mkdir(directory, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise ContainerManagerException({'Untrusted helper directory': directory})
+    url_hash = hashlib.sha1(str(params.get('client_url')).encode("utf-8")).hexdigest()[:8]
+    return os.path.join(directory, "helper-{0}.sock".format(url_hash))
+
+def check_helper_socket(path):
+    # The socket of another user could read the params, secrets included,
+    # and return any result
+    import stat
+
+    info = os.lstat(path)
+    if not stat.S_ISSOCK(info.st_mode) or info.st_uid != os.getuid():
+        raise ContainerManagerException({'Untrusted helper socket': path})
+
+def run_in_helper(module):
+    """
+    Send the request to the helper process, starting the helper if it is not
+    running. Returns None if the helper cannot be reached so that the module
+    can be run directly instead. Once the request has been sent the task may
+    have been done in part, so a failure after that is returned as a failed
+    result instead.
+    """
+    import errno
+    import socket
+
+    request = {'params': module.params, 'check_mode': module.check_mode}
+    deadline = None
+    try:
+        path = get_helper_socket(module.params)
+    except ContainerManagerException as e:
+        return {'failed': True, 'msg': str(e)}
+    while True:
+        try:
+            return helper_request(path, request)
+        except ContainerManagerException as e:
+            return {'failed': True, 'msg': str(e)}
+        except (socket.error, OSError) as e:
+            if e.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+                return None
+        if deadline is None:
+            spawn_helper(path, module.params)
+            deadline = time.time() + 10
+        elif time.time() > deadline:
+            return None
+        time.sleep(0.05)
 
-from ansible.module_utils.basic import *
-main()
+def helper_request(path, request):
+    import socket
+
+    check_helper_socket(path)
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+        conn.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        try:
+            response = read_message(conn)
+        except (socket.error, OSError, ValueError) as e:
+            raise ContainerManagerException("Helper failed while handling the request: {0}".format(e))
+    finally:
+        conn.close()
+    try:
+        return json.loads(response)
+    except ValueError:
+        # The helper died while handling the request
+        raise ContainerManagerException("Helper failed while handling the request: no response")
+
+def spawn_helper(path, params):
+    # Double fork so that the helper is not a child of the ansible task
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    try:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        Helper(path, params).serve()
+    finally:
+        os._exit(0)
+
+class Watcher():
+    """
+    Long-lived process that keeps the containers of a spec file in their
+    desired state between playbook runs.
+
+    Only the containers named in docker events are reconciled. The events of
+    a container that arrive within debounce seconds of each other are
+    handled by one reconciliation, at most rate containers are reconciled
+    per second, and every container is reconciled every resync_interval
+    seconds in case an event was missed.
+    """
+
+    # Container events that may leave a container out of its desired state
+    WATCHED_EVENTS = (
+        "create", "start", "restart", "die", "kill", "oom", "stop",
+        "pause", "unpause", "destroy", "rename", "update",
+    )
+    # Events that the changes made by the watcher itself may cause. Each is
+    # ignored once within OWN_EVENTS_TIMEOUT seconds, so that a
+    # reconciliation does not trigger another
+    OWN_EVENTS = {
+        'CREATED': ("create",),
+        'STARTED': ("start",),
+        'STOPPED': ("kill", "die", "stop"),
+        'RESTARTED': ("kill", "die", "stop", "start", "restart"),
+        'REMOVED': ("kill", "die", "stop", "destroy"),
+        'RENAMED': ("rename",),
+        'UPDATED': ("update",),
+    }
+    OWN_EVENTS_TIMEOUT = 10
+    LATENCY_SAMPLES = 1000
+
+    def __init__(self, params, debounce = 1.0, rate = 5.0, resync_interval = 900):
+        self.params = params
+        self.debounce = debounce
+        self.rate = rate
+        self.resync_interval = resync_interval
+        self.events_client = create_client(params)
+        # The events stream is quiet for as long as nothing happens
+        self.events_client.timeout = None
+        self.resilient = ResilientClient(create_client(params), params.get('retries') or 0, params.get('breaker_threshold'))
+        self.client = ProfilingClient(self.resilient)
+        self.inventory = Inventory(self.client)
+        self.root = ContainerManager(HelperModule(params), client = self.client, inventory = self.inventory)
+
+        specs = {}
+        for spec in params.get('containers') or []:
+            manager = self.root.create_child_manager(spec)
+            if manager.params['name'] in specs:
+                raise ContainerManagerException({'Duplicate container': manager.params['name']})
+            specs[manager.params['name']] = (spec, manager.get_dependencies())
+        if not specs:
+            raise ContainerManagerException({'No containers in spec file': params.get('containers')})
+        self.specs = dict((x, specs[x][0]) for x in specs)
+        self.waves = dict((name, i) for i, wave in enumerate(get_waves(dict((x, specs[x][1]) for x in specs))) for name in wave)
+        self.dependents = dict((x, sorted(y for y in specs if x in specs[y][1])) for x in specs)
+
+        self.lock = threading.Condition()
+        self.stopped = False
+        self.pending = {}
+        self.failures = {}
+        # Events of the containers being reconciled, by container name, and
+        # the events expected from the changes made, by container id
+        self.active = {}
+        self.own_events = {}
+        self.tokens = max(1.0, rate)
+        self.refilled = time.time()
+        self.counters = {
+            'events': 0, 'debounced': 0, 'resyncs': 0,
+            'reconciliations': 0, 'changed': 0, 'failed': 0,
+        }
+        self.latencies = []
+        self.durations = []
+        self.api_calls = {}
+
+    def run(self, stats_interval = 60, output = None):
+        events = threading.Thread(target = self.watch_events)
+        events.daemon = True
+        events.start()
+
+        next_resync = time.time()
+        next_stats = time.time() + stats_interval
+        while not self.stopped:
+            now = time.time()
+            if now >= next_resync:
+                self.resync()
+                next_resync = now + self.resync_interval
+            if output and now >= next_stats:
+                self.write_stats(output)
+                next_stats = now + stats_interval
+
+            batch = self.take_due()
+            if batch:
+                self.reconcile_batch(batch)
+                continue
+            with self.lock:
+                wakeup = min([next_resync] + [x['due'] for x in self.pending.values()])
+                if output:
+                    wakeup = min(wakeup, next_stats)
+                if not self.stopped:
+                    self.lock.wait(max(0.01, wakeup - time.time()))
+        if output:
+            self.write_stats(output)
+
+    def stop(self, *args):
+        with self.lock:
+            self.stopped = True
+            self.lock.notify()
+
+    def schedule(self, names, delay = None, recreated = ()):
+        now = time.time()
+        due = now + (self.debounce if delay is None else delay)
+        with self.lock:
+            for name in names:
+                entry = self.pending.get(name)
+                if entry:
+                    # Events within the debounce window of the first one are
+                    # handled by the same reconciliation
+                    self.counters['debounced'] += 1
+                    entry['due'] = min(entry['due'], due)
+                    entry['recreated'].update(recreated)
+                else:
+                    self.pending[name] = {'due': due, 'since': now, 'recreated': set(recreated)}
+            self.lock.notify()
+
+    def resync(self):
+        self.inventory.invalidate()
+        with self.lock:
+            self.counters['resyncs'] += 1
+        self.schedule(self.specs, delay = 0)
+
+    def take_due(self):
+        """
+        Remove and return the pending containers that are due, as many as
+        the rate limit allows.
+        """
+        with self.lock:
+            now = time.time()
+            if self.rate:
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.refilled) * self.rate)
+                self.refilled = now
+            due = sorted((x for x in self.pending if self.pending[x]['due'] <= now),
+                    key = lambda x: (self.waves[x], self.pending[x]['due']))
+            if self.rate:
+                due = due[:int(self.tokens)]
+                self.tokens -= len(due)
+                if not due and any(x['due'] <= now for x in self.pending.values()):
+                    # Wait for the next token rather than the next due time
+                    for entry in self.pending.values():
+                        entry['due'] = max(entry['due'], now + (1 - self.tokens) / self.rate)
+            return [(x, self.pending.pop(x)) for x in due]
+
+    def reconcile_batch(self, batch):
+        # The containers of a batch are reconciled in the order of their
+        # dependencies, and the ones of a wave concurrently
+        self.resilient.reset()
+        names = set(x for x, _ in batch)
+        recreated = set()
+        for wave in sorted(set(self.waves[x] for x in names)):
+            items = [x for x in batch if self.waves[x[0]] == wave]
+            for _, entry in items:
+                entry['recreated'].update(recreated)
+            results = run_concurrently(self.reconcile, items, self.params.get('parallelism') or 1)
+            recreated.update(x for x, _ in results if x)
+        # Dependents outside of the batch still use the containers that were
+        # removed
+        for name in sorted(recreated):
+            dependents = [x for x in self.dependents[name] if x not in names]
+            if dependents:
+                self.schedule(dependents, delay = 0, recreated = [name])
+        self.count_api_calls()
+
+    def reconcile(self, item):
+        """
+        Reconcile one container. Returns the name of the container if a new
+        container was created for it.
+        """
+        name, entry = item
+        start = time.time()
+        manager = None
+        error = None
+        with self.lock:
+            self.active[name] = []
+        try:
+            manager = self.root.create_child_manager(self.specs[name])
+            manager.reconcile(entry['recreated'])
+        except Exception as e:
+            error = e
+        end = time.time()
+
+        with self.lock:
+            events = self.active.pop(name)
+            if manager:
+                self.expect_own_events(manager.changes_made, end)
+            events = [x for x in events if not self.is_own_event(*x)]
+            self.counters['reconciliations'] += 1
+            self.latencies = (self.latencies + [end - entry['since']])[-self.LATENCY_SAMPLES:]
+            self.durations = (self.durations + [end - start])[-self.LATENCY_SAMPLES:]
+            if error:
+                self.counters['failed'] += 1
+                self.failures[name] = self.failures.get(name, 0) + 1
+                retry = min(self.resync_interval, self.debounce * 2 ** self.failures[name])
+            else:
+                self.failures.pop(name, None)
+                if manager.changes_made:
+                    self.counters['changed'] += 1
+
+        if error:
+            self.log("{0}: failed, retrying in {1:.1f}s: {2}".format(name, retry, error))
+            self.schedule([name], delay = retry)
+            return None
+        if events:
+            self.schedule([name])
+        if manager.changes_made:
+            self.log("{0}: {1}".format(name, json.dumps(manager.changes_made, sort_keys = True)))
+        if manager.recreated or any('CREATED' in x for x in manager.changes_made):
+            return name
+        return None
+
+    def watch_events(self):
+        while not self.stopped:
+            try:
+                stream = self.events_client.events(filters = {'type': ["container", "image"]})
+                for event in decode_json_stream(stream):
+                    self.handle_event(event)
+                    if self.stopped:
+                        return
+            except Exception as e:
+                self.log("Events stream failed: {0}".format(e))
+            # Events may have been missed while the stream was down
+            time.sleep(1)
+            self.resync()
+
+    def handle_event(self, event):
+        self.inventory.invalidate(event)
+        status = event.get('status') or event.get('Action') or ""
+        if event.get('Type', "container") != "container" or status.split(":")[0] not in self.WATCHED_EVENTS:
+            return
+        attributes = (event.get('Actor') or {}).get('Attributes') or {}
+        names = [attributes[x].lstrip("/") for x in ('name', 'oldName') if attributes.get(x)]
+        names = [x for x in names if x in self.specs]
+        own = (event.get('id'), status.split(":")[0])
+        with self.lock:
+            self.counters['events'] += 1
+            for name in names:
+                if name in self.active:
+                    # Decided once the changes of the reconciliation are known
+                    self.active[name].append(own)
+            names = [x for x in names if x not in self.active]
+            if self.is_own_event(*own):
+                names = []
+        if names:
+            self.schedule(names)
+
+    def expect_own_events(self, changes, now):
+        for change in changes:
+            for action, info in change.items():
+                if info.get('Id') and action in self.OWN_EVENTS:
+                    actions, _ = self.own_events.get(info['Id'], ([], None))
+                    self.own_events[info['Id']] = (actions + list(self.OWN_EVENTS[action]), now + self.OWN_EVENTS_TIMEOUT)
+        for container_id, (_, expires) in list(self.own_events.items()):
+            if expires < now:
+                del self.own_events[container_id]
+
+    def is_own_event(self, container_id, action):
+        actions, expires = self.own_events.get(container_id, ([], 0))
+        if action not in actions or time.time() >= expires:
+            return False
+        actions.remove(action)
+        return True
+
+    def count_api_calls(self):
+        summary = self.client.summary(clear = True)
+        with self.lock:
+            for name, calls in summary.items():
+                self.api_calls[name] = self.api_calls.get(name, 0) + calls['count']
+
+    def get_stats(self):
+        def summarize(values):
+            values = sorted(values)
+            if not values:
+                return None
+            return {
+                'p50': round(percentile(values, 50), 6),
+                'p90': round(percentile(values, 90), 6),
+                'max': round(values[-1], 6),
+            }
+
+        self.count_api_calls()
+        with self.lock:
+            stats = dict(self.counters)
+            stats['pending'] = len(self.pending)
+            stats['latency'] = summarize(self.latencies)
+            stats['duration'] = summarize(self.durations)
+            stats['api_calls'] = dict(self.api_calls)
+            stats['api_calls_total'] = sum(self.api_calls.values())
+            stats['retried'] = self.resilient.retried
+            return stats
+
+    def write_stats(self, output):
+        output.write(json.dumps(self.get_stats(), sort_keys = True) + "\n")
+        output.flush()
+
+    def log(self, msg):
+        sys.stderr.write("{0} {1}\n".format(time.strftime("%Y-%m-%dT%H:%M:%S"), msg))
+        sys.stderr.flush()
+
+def load_watch_spec(path):
+    """
+    Read the module options of a watch spec file, JSON or YAML, and add the
+    defaults of the options it does not set.
+    """
+    with open(path) as f:
+        data = f.read()
+    if path.endswith((".yml", ".yaml")):
+        import yaml
+        spec = yaml.safe_load(data)
+    else:
+        spec = json.loads(data)
+    if type(spec) is list:
+        spec = {'containers': spec}
+    if type(spec) is not dict:
+        raise ContainerManagerException({'Invalid spec file': path})
+    params = dict((k, v.get('default')) for k, v in ARGUMENT_SPEC.items())
+    params.update(check_options(spec))
+    return params
+
+def watch_main(argv):
+    import argparse
+    import signal
+
+    parser = argparse.ArgumentParser(prog = "dockerimp.py watch",
+            description = "Keep the containers of a spec file in their desired state")
+    parser.add_argument("spec", help = "JSON or YAML file with the containers option and other module options")
+    parser.add_argument("--debounce", type = float, default = 1.0,
+            help = "Seconds to wait for more events of a container before reconciling it")
+    parser.add_argument("--rate", type = float, default = 5.0,
+            help = "Containers reconciled per second at most, 0 for no limit")
+    parser.add_argument("--resync-interval", type = float, default = 900.0,
+            help = "Seconds between reconciliations of every container")
+    parser.add_argument("--stats-interval", type = float, default = 60.0,
+            help = "Seconds between the counter lines written to stdout")
+    args = parser.parse_args(argv)
+
+    import_docker()
+    try:
+        watcher = Watcher(load_watch_spec(args.spec), args.debounce, args.rate, args.resync_interval)
+    except (ContainerManagerException, IOError, ValueError) as e:
+        sys.stderr.write("{0}\n".format(e))
+        return 1
+    signal.signal(signal.SIGTERM, watcher.stop)
+    signal.signal(signal.SIGINT, watcher.stop)
+    watcher.run(args.stats_interval, sys.stdout)
+    return 0
+
+ARGUMENT_SPEC = {
+    'state': {
+        'default': None,
+        'choices': [
+            "present", "running", "running_latest",
+            "stopped", "absent", "restarted", "logs", "stats",
+            "image_present", "image_latest", "image_absent", "image_pruned",
+            "image_loaded", "image_saved",
+        ]
+    },
+    'containers':           { 'default': None, 'type': 'list' },
+    'client_url':           { 'default': "unix://var/run/docker.sock" },
+    'connect_timeout':      { 'default': 5, 'type': 'int' },
+    'read_timeout':         { 'default': 60, 'type': 'int' },
+    'retries':              { 'default': 3, 'type': 'int' },
+    'breaker_threshold':    { 'default': 5, 'type': 'int' },
+    'tls':                  { 'default': False, 'type': 'bool' },
+    'tls_verify':           { 'default': False, 'type': 'bool' },
+    'tls_ca_cert':          { 'default': None },
+    'tls_client_cert':      { 'default': None },
+    'tls_client_key':       { 'default': None },
+    'tls_hostname':         { 'default': None },
+    'hosts':                { 'default': None, 'type': 'list' },
+    'host_parallelism':     { 'default': 20, 'type': 'int' },
+    'max_failed_hosts':     { 'default': 0, 'type': 'int' },
+    'parallelism':          { 'default': 4, 'type': 'int' },
+    'name':                 { 'default': None, 'type': 'raw', 'aliases': ["id"] },
+    'image':                { 'default': None, 'type': 'raw' },
+    'env':                  { 'default': None },
+    'volumes':              { 'default': None },
+    'ports':                { 'default': None },
+    'command':              { 'default': None },
+    'expose':               { 'default': None },
+    'links':                { 'default': None },
+    'volumes_from':         { 'default': None },
+    'insecure_registry':    { 'default': False, 'type': 'bool' },
+    'latest_image':         { 'default': False, 'type': 'bool' },
+    'keep':                 { 'default': 1, 'type': 'int' },
+    'path':                 { 'default': None },
+    'tail':                 { 'default': None, 'type': 'int' },
+    'since':                { 'default': None },
+    'until':                { 'default': None },
+    'max_bytes':            { 'default': "1m" },
+    'grep':                 { 'default': None },
+    'label':                { 'default': None, 'type': 'raw' },
+    'window':               { 'default': 10, 'type': 'int' },
+    'mem_limit':            { 'default': None },
+    'memswap_limit':        { 'default': None },
+    'cpu_shares':           { 'default': None },
+    'cpuset':               { 'default': None },
+    'blkio_weight':         { 'default': None },
+    'restart_policy':       { 'default': None },
+    'stop_timeout':         { 'default': 10, 'type': 'int' },
+    'stop_signal':          { 'default': None },
+    'force_remove':         { 'default': False, 'type': 'bool' },
+    'remove_volumes':       { 'default': False, 'type': 'bool' },
+    'wait':                 { 'default': None, 'choices': ["running", "healthy"] },
+    'wait_timeout':         { 'default': 60, 'type': 'int' },
+    'replace_strategy':     { 'default': "stop_first", 'choices': ["stop_first", "start_first"] },
+    'replace_timeout':      { 'default': 60, 'type': 'int' },
+    'profile':              { 'default': False, 'type': 'bool' },
+    'profile_dump':         { 'default': None },
+    'helper':               { 'default': False, 'type': 'bool' },
+    'helper_socket':        { 'default': None },
+    'helper_idle_timeout':  { 'default': 600, 'type': 'int' },
+}
+
+# Options that apply to the whole run and cannot be set per container
+RUN_OPTIONS = HOST_OPTIONS + (
+    'containers', 'hosts', 'host_parallelism', 'max_failed_hosts',
+    'connect_timeout', 'read_timeout', 'retries', 'breaker_threshold',
+    'profile', 'profile_dump', 'helper', 'helper_socket', 'helper_idle_timeout',
+)
+
+BOOLEAN_TRUE = ("yes", "on", "true", "y", "t", "1")
+BOOLEAN_FALSE = ("no", "off", "false", "n", "f", "0", "")
+
+def check_options(options, names = None):
+    """
+    Check options that AnsibleModule does not see, such as the items of
+    containers and hosts, against ARGUMENT_SPEC: apply the aliases, refuse
+    unknown options and convert the values to the types of the spec.
+    """
+    names = names or list(ARGUMENT_SPEC)
+    aliases = dict((x, name) for name in names for x in ARGUMENT_SPEC[name].get('aliases') or [])
+    checked = {}
+    for key, value in options.items():
+        name = aliases.get(key, key)
+        if name not in names:
+            raise ContainerManagerException({'Unsupported option': key})
+        if name in checked:
+            raise ContainerManagerException({'Option given twice': name})
+        checked[name] = convert_option(name, value)
+    return checked
+
+def convert_option(name, value):
+    spec = ARGUMENT_SPEC[name]
+    if value is None:
+        return None
+    kind = spec.get('type')
+    try:
+        if kind == 'int':
+            if isinstance(value, bool):
+                raise ValueError(value)
+            value = int(value)
+        elif kind == 'bool' and not isinstance(value, bool):
+            text = str(value).strip().lower()
+            if text not in BOOLEAN_TRUE + BOOLEAN_FALSE:
+                raise ValueError(value)
+            value = text in BOOLEAN_TRUE
+        elif kind == 'list' and not isinstance(value, list):
+            value = [x.strip() for x in str(value).split(",") if x.strip()]
+    except (TypeError, ValueError):
+        raise ContainerManagerException({'Invalid value': "{0}: {1}".format(name, value)})
+    if spec.get('choices') and value not in spec['choices']:
+        raise ContainerManagerException({'Invalid value': "{0}: {1}".format(name, value)})
+    return value
+
+def main():
+    if sys.argv[1:2] == ["watch"]:
+        sys.exit(watch_main(sys.argv[2:]))
+
+    if AnsibleModule is None:
+        print("Failed to import module ansible")
+        sys.exit(1)
+    module = AnsibleModule(argument_spec = ARGUMENT_SPEC, supports_check_mode = True)
+    if not module.params.get('state') and not module.params.get('containers'):
+        module.fail_json(msg = "state or containers is required")
+
+    result = None
+    if module.params.get('hosts'):
+        result = run_hosts(module)
+    elif module.params.get('helper'):
+        result = run_in_helper(module)
+    if result is None:
+        result = run_manager(module)
+    if result.get('failed'):
+        module.fail_json(**result)
+    module.exit_json(**result)
+
+try:
+    from ansible.module_utils.basic import *
+except ImportError:
+    # The watch mode runs as a standalone daemon on hosts without ansible
+    AnsibleModule = None
+if __name__ == "__main__":
+    main()